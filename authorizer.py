@@ -1,11 +1,15 @@
-import asyncio
+import json
 import re
+import sys
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Optional
 
 import jwt
 
 import utils
-from models.users import UserDocument, find_user
-from services.secrets import get_secret
+from config import get_config
+from models.users import find_user
+from utils import auth, runtime
 from utils.logging import LOG_MANAGER
 
 logger = LOG_MANAGER.getLogger(__name__)
@@ -41,63 +45,63 @@ def lambda_handler(event, context):
     The example policy below denies access to all resources in the RestApi.
     """
 
-    logger.info("Authorizer received event: " + str(event),)
-
-    policy = AuthPolicy(event)
+    route_arn = event["routeArn"]
+    logger.info("Method ARN: " + route_arn)
+    target = parse_route_arn(route_arn)
 
     if "authorization-token" not in event["headers"]:
         logger.info("No token was passed")
-        policy.denyAllMethods()
-        authResponse = policy.build()
-        return authResponse
-
-    logger.info("Client token: " + event["headers"]["authorization-token"],)
-    logger.info("Method ARN: " + event["routeArn"])
+        return build_policy(target, "Deny", ANONYMOUS)
 
     token = event["headers"]["authorization-token"]
-    try:
-        payload = jwt.decode(
-            token,
-            key=get_secret(),
-            algorithms=[
-                "HS256",
-            ],
-        )
-    except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError):
-        policy.denyAllMethods()
-        authResponse = policy.build()
-        return authResponse
-
-    async def get_user(username: str) -> UserDocument:
-        await utils.setup()
-        return await find_user(username)
-
-    found_user = asyncio.run(get_user(payload["username"]))
-
-    if payload["username"] == found_user.username:
-        logger.info(
-            "User authorized",
-            extra={
-                "username": payload["username"],
-                "found_user": found_user.username,
-            },
-        )
-        policy.allowAllMethods()
-    else:
-        logger.info(
-            "User not authorized",
-            extra={
-                "username": payload["username"],
-                "found_user": found_user.username,
-            },
-        )
-        policy.denyAllMethods()
-    # policy.allowMethod(HttpVerb.GET, '/pets/*')
-
-    # Finally, build the policy
-    authResponse = policy.build()
-
-    return authResponse
+    decision = auth.get_decision(token)
+    if decision is None:
+        try:
+            payload = utils.decode_token(token)
+        except (jwt.exceptions.DecodeError,
+                jwt.exceptions.ExpiredSignatureError):
+            return build_policy(target, "Deny", ANONYMOUS)
+
+        decision = runtime.run(authorize(payload))
+        auth.cache_decision(token, decision, payload.get("exp", 0))
+
+    routes = allowed_routes(ROUTE_SCOPES, decision.scopes, decision.username)
+    if not decision.allowed or not routes:
+        logger.info("User not authorized",
+                    extra={"username": decision.username})
+        return build_policy(target, "Deny", decision.username)
+
+    logger.info("User authorized", extra={"username": decision.username})
+    # API Gateway caches the policy per token and checks every later request
+    # against it, so it lists each route the token's scopes allow. Built
+    # policies are shared between requests, never modify them in place.
+    # Handlers read the caller from the context instead of decoding the token
+    return {
+        **build_policy(target, "Allow", decision.username, routes),
+        "context": decision.context(),
+    }
+
+
+async def authorize(payload: dict) -> auth.Decision:
+    """Allow a token whose user exists and has not revoked it since"""
+    await utils.setup()
+    if get_config().auth_mode == "stateless":
+        # Only tokens issued before the user's last revocation are refused
+        version = await auth.REVOCATIONS.get_version(payload["username"])
+        return auth.Decision(payload["username"],
+                             payload.get("ver", 0) >= version,
+                             auth.effective_scopes(payload.get("scope", [])),
+                             payload.get("uid", ""))
+
+    found_user = await find_user(payload["username"])
+    if (found_user is None or
+            payload.get("ver", 0) != found_user.token_version):
+        return auth.Decision(payload["username"], False)
+    # Scopes the user lost since the token was issued no longer apply
+    return auth.Decision(
+        found_user.username, True,
+        auth.grant_scopes(found_user.scopes, payload.get("scope", [])),
+        str(found_user.id))
 
 
 class HttpVerb:
@@ -111,6 +115,146 @@ class HttpVerb:
     ALL = "*"
 
 
+# Principal of requests without a valid token
+ANONYMOUS = "anonymous"
+
+# The regular expression used to validate resource paths for the policy
+PATH_REGEX = r"^[/.a-zA-Z0-9_\-\*]+$"
+PATH_PATTERN = re.compile(PATH_REGEX)
+
+
+class ApiTarget(NamedTuple):
+    """The API stage a route ARN belongs to, which policy ARNs are built for"""
+    region: str
+    account_id: str
+    api_id: str
+    stage: str
+
+
+class ScopeRule(NamedTuple):
+    """A route and the token scope needed to call it, None for any caller.
+
+    ``owner`` names a path parameter that must be the caller's username, for
+    routes that only change the caller's own resources.
+    """
+    verb: str
+    path: str
+    scope: Optional[str] = None
+    owner: Optional[str] = None
+
+
+ALL_ROUTES = ((HttpVerb.ALL, "*"),)
+
+# Every route behind the authorizer in serverless.yml and the scope it needs.
+# `make routes` checks that the two agree
+ROUTE_SCOPES = (
+    ScopeRule(HttpVerb.GET, "/posts", auth.READ),
+    ScopeRule(HttpVerb.POST, "/posts", auth.WRITE),
+    ScopeRule(HttpVerb.GET, "/posts/{id}", auth.READ),
+    ScopeRule(HttpVerb.PUT, "/posts/{id}", auth.WRITE),
+    ScopeRule(HttpVerb.DELETE, "/posts/{id}", auth.WRITE),
+    ScopeRule(HttpVerb.POST, "/posts/{id}/like", auth.WRITE),
+    ScopeRule(HttpVerb.POST, "/posts/{id}/unlike", auth.WRITE),
+    ScopeRule(HttpVerb.GET, "/posts/{id}/likes", auth.READ),
+    ScopeRule(HttpVerb.POST, "/posts/{id}/comment", auth.WRITE),
+    ScopeRule(HttpVerb.GET, "/posts/{id}/comments", auth.READ),
+    ScopeRule(HttpVerb.POST, "/posts/{id}/comment/{commentId}/like",
+              auth.WRITE),
+    ScopeRule(HttpVerb.POST, "/posts/{id}/comment/{commentId}/unlike",
+              auth.WRITE),
+    ScopeRule(HttpVerb.DELETE, "/posts/{id}/comment/{commentId}", auth.WRITE),
+    ScopeRule(HttpVerb.GET, "/categories", auth.READ),
+    ScopeRule(HttpVerb.GET, "/users", auth.ADMIN),
+    ScopeRule(HttpVerb.GET, "/users/{username}", auth.READ),
+    ScopeRule(HttpVerb.PUT, "/users/{username}", auth.WRITE, owner="username"),
+    ScopeRule(HttpVerb.GET, "/users/{username}/followers", auth.READ),
+    ScopeRule(HttpVerb.GET, "/users/{username}/following", auth.READ),
+    ScopeRule(HttpVerb.POST, "/follow/{username}", auth.WRITE),
+    ScopeRule(HttpVerb.POST, "/unfollow/{username}", auth.WRITE),
+)
+
+PATH_PARAMETER = re.compile(r"\{(\w+)\}")
+
+
+@lru_cache(maxsize=256)
+def parse_route_arn(route_arn: str) -> ApiTarget:
+    # arn:aws:execute-api:{region}:{account}:{api id}/{stage}/{verb}/{path}
+    _, _, _, region, account_id, resource = route_arn.split(":", 5)
+    api_id, stage, _ = resource.split("/", 2)
+    return ApiTarget(region, account_id, api_id, stage)
+
+
+def _resource_path(rule: ScopeRule, username: str) -> Optional[str]:
+    """The policy resource of a route, with its owner parameter set to
+    ``username`` and any other parameter matching every value.
+
+    None when the route has an owner and ``username`` cannot be used in a
+    resource ARN.
+    """
+    if rule.owner is not None and not PATH_PATTERN.match(username):
+        return None
+    return PATH_PARAMETER.sub(
+        lambda match: username if match[1] == rule.owner else "*", rule.path)
+
+
+def allowed_routes(table: Iterable[ScopeRule],
+                   scopes: Iterable[str],
+                   username: str = ANONYMOUS) -> tuple[tuple[str, str], ...]:
+    """The (verb, resource path) pairs of ``table`` that ``scopes`` grant
+    ``username`` access to"""
+    return _allowed_routes(tuple(table), frozenset(scopes), username)
+
+
+@lru_cache(maxsize=1024)
+def _allowed_routes(table: tuple[ScopeRule, ...], scopes: frozenset[str],
+                    username: str) -> tuple[tuple[str, str], ...]:
+    routes = []
+    for rule in table:
+        if rule.scope is not None and rule.scope not in scopes:
+            continue
+        path = _resource_path(rule, username)
+        if path is not None:
+            routes.append((rule.verb, path))
+    return tuple(routes)
+
+
+def check_routes(serverless_config: dict) -> list[str]:
+    """Compare ROUTE_SCOPES with the authorized httpApi routes of a resolved
+    serverless config, as printed by ``sls print --format json``.
+
+    Returns a description of every route found in only one of them.
+    """
+    configured = set()
+    for function in serverless_config.get("functions", {}).values():
+        for event in function.get("events", []):
+            http_api = event.get("httpApi")
+            if isinstance(http_api, dict) and http_api.get("authorizer"):
+                configured.add((http_api["method"].upper(), http_api["path"]))
+
+    table = {(rule.verb, rule.path) for rule in ROUTE_SCOPES}
+    return ([f"no scope for {verb} {path}"
+             for verb, path in sorted(configured - table)] +
+            [f"not in serverless.yml: {verb} {path}"
+             for verb, path in sorted(table - configured)])
+
+
+@lru_cache(maxsize=1024)
+def build_policy(target: ApiTarget,
+                 effect: str,
+                 principal: str,
+                 routes: tuple[tuple[str, str], ...] = ALL_ROUTES) -> dict:
+    """Build, once per distinct set of arguments, the policy allowing or
+    denying ``principal`` the given routes of an API stage.
+
+    The returned dict is shared by every caller with the same arguments and
+    must not be modified.
+    """
+    policy = AuthPolicy(target, principal)
+    for verb, path in routes:
+        policy._addMethod(effect, verb, path, [])
+    return policy.build()
+
+
 class AuthPolicy(object):
     # The AWS account id the policy will be generated for. This is used to create the method ARNs.
     awsAccountId = ""
@@ -119,7 +263,7 @@ class AuthPolicy(object):
     # The policy version used for the evaluation. This should always be '2012-10-17'
     version = "2012-10-17"
     # The regular expression used to validate resource paths for the policy
-    pathRegex = "^[/.a-zA-Z0-9-\*]+$"
+    pathRegex = PATH_REGEX
     """Internal lists of allowed and denied methods.
 
     These are lists of objects and each object has 2 properties: A resource
@@ -141,14 +285,12 @@ class AuthPolicy(object):
     See https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_elements_resource.html for more details."""
     stage = "<<stage>>"
 
-    def __init__(self, event):
-        tmp = event["routeArn"].split(":")
-        apiGatewayArnTmp = tmp[5].split("/")
-        self.restApiId = apiGatewayArnTmp[0]
-        self.region = tmp[3]
-        self.stage = apiGatewayArnTmp[1]
-        self.awsAccountId = tmp[4]
-        self.principalId = "user|a1b2c3d4"
+    def __init__(self, target: ApiTarget, principal: str = ANONYMOUS):
+        self.restApiId = target.api_id
+        self.region = target.region
+        self.stage = target.stage
+        self.awsAccountId = target.account_id
+        self.principalId = principal
         self.allowMethods = []
         self.denyMethods = []
 
@@ -159,8 +301,7 @@ class AuthPolicy(object):
         if verb != "*" and not hasattr(HttpVerb, verb):
             raise NameError("Invalid HTTP verb " + verb +
                             ". Allowed verbs in HttpVerb class")
-        resourcePattern = re.compile(self.pathRegex)
-        if not resourcePattern.match(resource):
+        if not PATH_PATTERN.match(resource):
             raise NameError("Invalid resource path: " + resource +
                             ". Path should match " + self.pathRegex)
 
@@ -273,3 +414,10 @@ class AuthPolicy(object):
             self._getStatementForEffect("Deny", self.denyMethods))
 
         return policy
+
+
+if __name__ == "__main__":
+    problems = check_routes(json.load(sys.stdin))
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
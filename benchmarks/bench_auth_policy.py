@@ -0,0 +1,70 @@
+"""Authorizer policy construction.
+
+    pipenv run python -m benchmarks.bench_auth_policy --runs 100000
+
+Times the previous per-request policy build, which parsed the route ARN and
+called ``re.compile`` on the path pattern for every method, against the
+memoized ``authorizer.build_policy``, for allow-all and for the per-route allow
+list of a default token. No database is needed.
+"""
+import argparse
+import re
+import time
+
+import authorizer
+from authorizer import ROUTE_SCOPES, AuthPolicy
+from utils import auth
+
+ROUTE_ARN = "arn:aws:execute-api:us-east-1:123456789012:api/dev/GET/posts"
+
+
+class _LegacyPolicy(AuthPolicy):
+
+    def __init__(self, event, principal):
+        super().__init__(authorizer.parse_route_arn.__wrapped__(
+            event["routeArn"]), principal)
+
+    def _addMethod(self, effect, verb, resource, conditions):
+        re.compile(self.pathRegex)
+        super()._addMethod(effect, verb, resource, conditions)
+
+
+def _legacy(event: dict, routes) -> dict:
+    policy = _LegacyPolicy(event, "benchmark")
+    for verb, path in routes:
+        policy.allowMethod(verb, path)
+    return policy.build()
+
+
+def _memoized(event: dict, routes) -> dict:
+    target = authorizer.parse_route_arn(event["routeArn"])
+    return authorizer.build_policy(target, "Allow", "benchmark", routes)
+
+
+def _time(name: str, build, routes, runs: int):
+    event = {"routeArn": ROUTE_ARN}
+    build(event, routes)
+    start = time.perf_counter()
+    for _ in range(runs):
+        build(event, routes)
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{name:<20} {elapsed * 1e6:10.2f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=100000)
+    args = parser.parse_args()
+
+    routes = authorizer.allowed_routes(ROUTE_SCOPES, auth.DEFAULT_SCOPES,
+                                       "benchmark")
+    for name, policy_routes in (("all", authorizer.ALL_ROUTES),
+                                ("per route", routes)):
+        event = {"routeArn": ROUTE_ARN}
+        assert _legacy(event, policy_routes) == _memoized(event, policy_routes)
+        _time(f"legacy {name}", _legacy, policy_routes, args.runs)
+        _time(f"memoized {name}", _memoized, policy_routes, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Authorizer latency in the lookup and stateless auth modes.
+
+Run from the repository root against a real MongoDB:
+
+    pipenv run python -m benchmarks.bench_authorizer --iterations 200
+
+Every iteration authorizes a token the container has not seen yet, so the
+decision cache misses and the configured mode decides. A final row shows a
+repeated token answered from the decision cache.
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+
+import authorizer
+import utils
+from config import get_config
+from models.users import UserDocument
+from services.secrets import get_secret
+from utils import auth, runtime
+
+ROUTE_ARN = "arn:aws:execute-api:us-east-1:123456789012:api/dev/GET/posts"
+
+
+class _Context:
+    function_name = "bench_authorizer"
+
+
+async def _ensure_user() -> UserDocument:
+    await utils.setup()
+    user = await UserDocument.find_one(UserDocument.username == "benchmark")
+    if not user:
+        user = UserDocument(username="benchmark", password="benchmark")
+        await user.save()
+    return user
+
+
+def _token(user: UserDocument, i: int) -> str:
+    payload = {
+        "username": user.username,
+        "scope": user.scopes,
+        "ver": user.token_version,
+        # A distinct exp per token keeps every token out of the cache
+        "exp": datetime.now(tz=timezone.utc) + timedelta(days=1, seconds=i),
+    }
+    return jwt.encode(payload=payload, key=get_secret())
+
+
+def _authorize(token: str) -> float:
+    event = {"headers": {"authorization-token": token}, "routeArn": ROUTE_ARN}
+    start = time.perf_counter()
+    response = authorizer.lambda_handler(event, _Context())
+    elapsed = (time.perf_counter() - start) * 1000
+    assert response["policyDocument"]["Statement"][0]["Effect"] == "Allow"
+    return elapsed
+
+
+def _report(name: str, timings: list[float]):
+    timings = sorted(timings)
+    print(f"{name:<10} p50={statistics.median(timings):8.3f}ms "
+          f"p99={timings[int(len(timings) * 0.99) - 1]:8.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    user = runtime.run(_ensure_user())
+    tokens = [_token(user, i) for i in range(args.iterations)]
+
+    for mode in ("lookup", "stateless"):
+        get_config().auth_mode = mode
+        auth.DECISIONS.clear()
+        # Warm up the connection and, in stateless mode, the revocation list
+        _authorize(_token(user, -1))
+        _report(mode, [_authorize(token) for token in tokens])
+
+    _report("cached", [_authorize(tokens[0]) for _ in tokens])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Import time of each Lambda handler module in a fresh interpreter.
+
+    pipenv run python -m benchmarks.bench_cold_start --runs 5 --top 10
+
+Every run starts a new Python process, like a cold Lambda container, and
+times ``import <module>``. ``--top`` also lists the packages that take the
+longest to import, as reported by ``python -X importtime``.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HANDLER_MODULES = [
+    "authorizer",
+    "handlers.login",
+    "handlers.posts",
+    "handlers.users",
+]
+
+_TIMER = ("import time; start = time.perf_counter(); import {module}; "
+          "print(time.perf_counter() - start)")
+
+
+def _import_time(module: str) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", _TIMER.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1]) * 1000
+
+
+def _slowest_imports(module: str, top: int) -> list[tuple[int, str]]:
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    # The outermost import of a package includes all of its submodules
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        if package != module.split(".")[0]:
+            packages[package] = max(packages.get(package, 0), int(cumulative))
+    return sorted(((cumulative, package)
+                   for package, cumulative in packages.items()),
+                  reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for module in HANDLER_MODULES:
+        timings = [_import_time(module) for _ in range(args.runs)]
+        print(f"{module:<16} median={statistics.median(timings):8.2f}ms "
+              f"min={min(timings):8.2f}ms")
+        for cumulative, name in _slowest_imports(module, args.top):
+            print(f"    {cumulative / 1000:8.2f}ms {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Event loop overhead per request: asyncio.run versus the shared runtime.
+
+    pipenv run python -m benchmarks.bench_event_loop --iterations 10000
+    EVENT_LOOP=uvloop pipenv run python -m benchmarks.bench_event_loop
+"""
+import argparse
+import asyncio
+import time
+
+from utils import runtime
+
+
+async def _handler_body():
+    await asyncio.sleep(0)
+    return {"statusCode": 200}
+
+
+def _time(name: str, dispatch, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        dispatch(_handler_body())
+    elapsed = time.perf_counter() - start
+    print(f"{name:<14} {elapsed / iterations * 1e6:8.2f}us per request")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    _time("asyncio.run", asyncio.run, args.iterations)
+    _time("runtime.run", runtime.run, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Reply tree construction for large threads.
+
+    pipenv run python -m benchmarks.bench_replies_tree --replies 10000
+
+Builds a random thread where every reply answers the post or an earlier
+reply, then times the previous recursive builder against
+``make_replies_tree``. The recursive builder is skipped above
+``--legacy-limit`` replies because it is quadratic.
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+from ulid import ULID
+
+from models.posts import Reply, ReplyDocument, make_replies_tree
+
+
+def _legacy_replies_tree(replies: list[ReplyDocument],
+                         parent_ulid: str = "") -> list[Reply]:
+    tree = []
+    for reply in replies:
+        if reply.parent_ulid == parent_ulid:
+            tree.append(
+                Reply(**reply.dict(),
+                      replies=_legacy_replies_tree(replies, reply.ulid)))
+    return tree
+
+
+def _thread(size: int, seed: int) -> list[ReplyDocument]:
+    rng = random.Random(seed)
+    now = datetime.now()
+    replies = []
+    for _ in range(size):
+        parent = rng.choice(replies).ulid if replies and rng.random() < 0.7 else ""
+        replies.append(
+            ReplyDocument(ulid=str(ULID()),
+                          author="benchmark",
+                          content="reply",
+                          created_at=now,
+                          updated_at=now,
+                          parent_ulid=parent))
+    return replies
+
+
+def _time(name: str, build, replies: list[ReplyDocument]):
+    start = time.perf_counter()
+    build(replies)
+    print(f"{name:<10} {(time.perf_counter() - start) * 1000:10.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replies", type=int, default=10000)
+    parser.add_argument("--legacy-limit", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    replies = _thread(args.replies, args.seed)
+    print(f"{len(replies)} replies")
+    if args.replies <= args.legacy_limit:
+        _time("recursive", _legacy_replies_tree, replies)
+    _time("single", make_replies_tree, replies)
+    _time("depth=3", lambda r: make_replies_tree(r, max_depth=3), replies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Feed response encoding.
+
+    pipenv run python -m benchmarks.bench_serialization --posts 500
+
+Builds a feed page of projected posts, the way ``get_recent_posts`` returns
+them, and times the previous ``post.dict()`` + ``json.dumps`` encoding against
+``models.serialization.dumps``.
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+from ulid import ULID
+
+from models.posts import PostBase
+from models.serialization import dumps, orjson
+
+
+def _serialize_datetime(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def _legacy_dumps(posts: list[PostBase]) -> str:
+    return json.dumps(
+        {
+            "posts": [post.dict() for post in posts],
+            "next_cursor": posts[-1].ulid
+        },
+        default=_serialize_datetime)
+
+
+def _dumps(posts: list[PostBase]) -> str:
+    return dumps({"posts": posts, "next_cursor": posts[-1].ulid})
+
+
+def _feed(size: int) -> list[PostBase]:
+    now = datetime.now()
+    return [
+        PostBase(ulid=str(ULID()),
+                 title=f"Post {i}",
+                 author=f"user_{i % 50}",
+                 content="lorem ipsum " * 40,
+                 categories=["news", "tech"],
+                 like_count=i,
+                 created_at=now,
+                 updated_at=now) for i in range(size)
+    ]
+
+
+def _time(name: str, encode, posts: list[PostBase], runs: int):
+    encode(posts)
+    start = time.perf_counter()
+    for _ in range(runs):
+        encode(posts)
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{name:<10} {elapsed * 1000:10.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    posts = _feed(args.posts)
+    assert json.loads(_legacy_dumps(posts)) == json.loads(_dumps(posts))
+    print(f"{len(posts)} posts, orjson {'on' if orjson else 'off'}")
+    _time("legacy", _legacy_dumps, posts, args.runs)
+    _time("dumps", _dumps, posts, args.runs)
+
+
+if __name__ == "__main__":
+    main()
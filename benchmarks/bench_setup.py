@@ -0,0 +1,55 @@
+"""Per-request cost of utils.setup() before and after connection reuse.
+
+Run from the repository root against a real MongoDB:
+
+    pipenv run python -m benchmarks.bench_setup --iterations 50
+
+Each iteration mimics one warm Lambda invocation: a fresh ``asyncio.run``
+followed by the database setup and a single ``find_one``.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import utils
+from config import get_config
+from models.posts import PostDocument
+from models.users import UserDocument
+
+
+async def _setup_per_request():
+    db = AsyncIOMotorClient(get_config().mongo_uri).social_media
+    await init_beanie(db, document_models=[UserDocument, PostDocument])
+
+
+async def _invocation(setup):
+    start = time.perf_counter()
+    await setup()
+    await UserDocument.find_one(UserDocument.username == "benchmark")
+    return (time.perf_counter() - start) * 1000
+
+
+def _run(name: str, setup, iterations: int):
+    timings = [asyncio.run(_invocation(setup)) for _ in range(iterations)]
+    # the first call pays the cold start in both modes
+    warm = timings[1:] or timings
+    print(f"{name:<12} cold={timings[0]:8.2f}ms "
+          f"p50={statistics.median(warm):8.2f}ms "
+          f"max={max(warm):8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    _run("per-request", _setup_per_request, args.iterations)
+    _run("shared", utils.setup, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Concurrent likes and unlikes on one post must not lose updates.
+
+    pipenv run python -m benchmarks.likes_concurrency --users 200
+
+Likes the same post from ``--users`` distinct users at once (each user
+twice, to exercise the duplicate path), then unlikes half of them. The
+script exits non-zero if the post's like_count ever disagrees with the
+likes collection.
+
+Duplicate likes are only rejected by the unique (post_ulid, username)
+index, so the script creates the declared indexes first.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from ulid import ULID
+
+import utils
+from models.indexes import ensure_indexes
+from models.likes import LikeDocument, like_post, unlike_post
+from models.posts import PostDocument
+from utils import runtime
+
+
+async def _check(name: str, post: PostDocument, expected: int,
+                 elapsed: float) -> bool:
+    stored = await PostDocument.find_one(PostDocument.ulid == post.ulid)
+    likes = await LikeDocument.find(LikeDocument.post_ulid == post.ulid).count()
+    print(f"{name:<8} {elapsed:8.2f}ms likes={likes}/{expected} "
+          f"like_count={stored.like_count}")
+    return likes == stored.like_count == expected
+
+
+async def main(users: int) -> bool:
+    await utils.setup()
+    await ensure_indexes()
+    post = PostDocument(ulid=str(ULID()),
+                        title="likes benchmark",
+                        author="benchmark",
+                        content="")
+    await post.save()
+    usernames = [f"user_{i}" for i in range(users)]
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[like_post(post.ulid, username) for username in usernames * 2])
+        liked = await _check("like", post, users,
+                             (time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            unlike_post(post.ulid, username)
+            for username in usernames[:users // 2] * 2
+        ])
+        unliked = await _check("unlike", post, users - users // 2,
+                               (time.perf_counter() - start) * 1000)
+    finally:
+        await LikeDocument.find(LikeDocument.post_ulid == post.ulid).delete()
+        await post.delete()
+
+    return liked and unliked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+    sys.exit(0 if runtime.run(main(args.users)) else 1)
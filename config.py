@@ -1,35 +1,171 @@
 import json
-from typing import Any, Union
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Optional, Union
 
-import boto3
 from pydantic import BaseSettings
 from pydantic.env_settings import SettingsSourceCallable
 
-ssm_client = boto3.client("ssm", region_name="us-east-1")
-
 from utils.logging import LOG_MANAGER
 
 logger = LOG_MANAGER.getLogger(__name__)
 
+PARAMETER_PATH = "/social-media-backend/"
+CACHE_FILE = "/tmp/social-media-backend-config.json"
+
+# GetParameters accepts at most 10 names per call
+GET_PARAMETERS_BATCH_SIZE = 10
+
+
+class SSMParameterBackend:
+    """Loads every parameter under a path from SSM Parameter Store.
+
+    By default all parameters are read with paginated ``GetParametersByPath``
+    calls. With ``concurrent=True`` the requested names are split into
+    ``GetParameters`` batches that are fetched in parallel instead.
+    """
+
+    def __init__(self,
+                 path: str = PARAMETER_PATH,
+                 region_name: str = "us-east-1",
+                 concurrent: bool = False):
+        self.path = path
+        self.region_name = region_name
+        self.concurrent = concurrent
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            # boto3 is slow to import, only pay for it when SSM is used
+            import boto3
+            self._client = boto3.client("ssm", region_name=self.region_name)
+        return self._client
+
+    def load(self, names: list[str]) -> dict[str, str]:
+        if self.concurrent:
+            return self._load_by_name(names)
+        return self._load_by_path()
+
+    def _load_by_path(self) -> dict[str, str]:
+        logger.info(f"Getting parameters under {self.path}")
+        paginator = self.client.get_paginator("get_parameters_by_path")
+        values = {}
+        for page in paginator.paginate(Path=self.path, WithDecryption=True):
+            for parameter in page["Parameters"]:
+                values[parameter["Name"][len(self.path):]] = parameter["Value"]
+        return values
+
+    def _get_parameters(self, names: list[str]) -> dict[str, str]:
+        response = self.client.get_parameters(
+            Names=[f"{self.path}{name}" for name in names], WithDecryption=True)
+        return {
+            parameter["Name"][len(self.path):]: parameter["Value"]
+            for parameter in response["Parameters"]
+        }
 
-class SecretManagerConfig:
+    def _load_by_name(self, names: list[str]) -> dict[str, str]:
+        logger.info(f"Getting parameters {names}")
+        batches = [
+            names[i:i + GET_PARAMETERS_BATCH_SIZE]
+            for i in range(0, len(names), GET_PARAMETERS_BATCH_SIZE)
+        ]
+        values = {}
+        with ThreadPoolExecutor(max_workers=max(len(batches), 1)) as executor:
+            for batch in executor.map(self._get_parameters, batches):
+                values.update(batch)
+        return values
+
+
+class LocalParameterBackend:
+    """Loads parameters from a JSON file so config can be tested without AWS.
+
+    Without a file it returns nothing and the settings are taken from the
+    environment.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+
+    def load(self, names: list[str]) -> dict[str, str]:
+        if not self.path:
+            return {}
+        with open(self.path) as f:
+            values = json.load(f)
+        return {
+            name: value if isinstance(value, str) else json.dumps(value)
+            for name, value in values.items()
+            if name in names
+        }
 
-    @classmethod
-    def _get_secret(cls, secret_name: str) -> Union[str, dict[str, Any]]:
-        secret_name = f"/social-media-backend/{secret_name}"
-        logger.info(f"Getting secret {secret_name}")
-        secret_string = ssm_client.get_parameter(
-            Name=secret_name, WithDecryption=True)["Parameter"]["Value"]
+
+class FileCache:
+    """Caches loaded parameters on local disk for ``ttl`` seconds"""
+
+    def __init__(self, path: str = CACHE_FILE, ttl: float = 300):
+        self.path = path
+        self.ttl = ttl
+
+    def get(self) -> Optional[dict[str, str]]:
+        if self.ttl <= 0:
+            return None
+        try:
+            if time.time() - os.path.getmtime(self.path) > self.ttl:
+                return None
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+
+    def set(self, values: dict[str, str]):
+        if self.ttl <= 0:
+            return
         try:
-            return json.loads(secret_string)
+            # Parameters are decrypted, so keep the file private to this user
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(values, f)
+        except OSError as e:
+            logger.warning(f"Could not cache config to {self.path}: {e}")
+
+
+def _default_backend():
+    if os.environ.get("CONFIG_BACKEND", "ssm").lower() == "local":
+        return LocalParameterBackend(os.environ.get("CONFIG_FILE"))
+    return SSMParameterBackend(
+        concurrent=os.environ.get("CONFIG_CONCURRENT", "").lower() == "true")
+
+
+class SecretManagerConfig:
+    backend = _default_backend()
+    # Only remote lookups are worth caching
+    cache = FileCache(ttl=float(
+        os.environ.get("CONFIG_CACHE_TTL",
+                       300 if isinstance(backend, SSMParameterBackend) else 0)))
+
+    @staticmethod
+    def _parse(value: str) -> Union[str, dict[str, Any]]:
+        try:
+            return json.loads(value)
         except json.decoder.JSONDecodeError:
-            return secret_string
+            return value
 
     @classmethod
     def get_secrets(cls, settings: BaseSettings) -> dict[str, Any]:
+        names = list(settings.__fields__)
+        required = {
+            name for name, field in settings.__fields__.items()
+            if field.required
+        }
+        values = cls.cache.get()
+        if values is None or not required.issubset(values):
+            values = cls.backend.load(names)
+            cls.cache.set(values)
         return {
-            name: cls._get_secret(name)
-            for name, _ in settings.__fields__.items()
+            name: cls._parse(values[name]) for name in names if name in values
         }
 
     @classmethod
@@ -53,13 +189,36 @@ class Settings(BaseSettings):
     # Mongo Engine settings
     mongo_uri: str
 
-    # Neo4j settings
-    neo4j_uri: str
-    neo4j_username: str
-    neo4j_password: str
+    # Feed settings. "read" queries followed authors when the feed is read,
+    # "fanout" pushes new posts onto follower timelines when they are written
+    feed_mode: str = "read"
+    # Authors with more followers than this are merged in at read time
+    fanout_follower_threshold: int = 10000
+    timeline_max_length: int = 800
+
+    # Authorizer settings. "lookup" checks every new token against its user
+    # document, "stateless" trusts validly signed tokens unless the user is
+    # on the periodically refreshed revocation list
+    auth_mode: str = "lookup"
+
+    # Neo4j settings, only needed when the graph features are enabled
+    graph_enabled: bool = False
+    neo4j_uri: Optional[str] = None
+    neo4j_username: Optional[str] = None
+    neo4j_password: Optional[str] = None
 
     class Config(SecretManagerConfig):
         ...
 
 
-CONFIG = Settings()
+@lru_cache(maxsize=None)
+def get_config() -> Settings:
+    """Load the settings on first use rather than at import time"""
+    return Settings()
+
+
+def __getattr__(name: str):
+    # Keeps `from config import CONFIG` working while deferring the lookup
+    if name == "CONFIG":
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
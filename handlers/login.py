@@ -1,4 +1,3 @@
-import asyncio
 import json
 from datetime import datetime, timedelta, timezone
 
@@ -8,7 +7,7 @@ import pydantic
 import utils
 from models import Response
 from models.users import UserDocument, UserIn, find_user
-from services.secrets import get_secret
+from utils import auth, runtime
 
 
 def handler(event, context):
@@ -16,6 +15,9 @@ def handler(event, context):
     This is the handler for the login endpoint. It is responsible for
     authenticating a user and returning a JWT token that can be used to
     authenticate future requests.
+
+    An optional space separated ``scope`` in the body, such as ``"read"``,
+    limits the token to those of the user's scopes.
     """
 
     async def _login(event):
@@ -39,9 +41,18 @@ def handler(event, context):
             return Response(statusCode=403,
                             body={"reason": "incorrect password"})
 
-        token = utils.generate_token(found_user)
+        scopes = None
+        if body.get("scope"):
+            requested = tuple(dict.fromkeys(body["scope"].split()))
+            scopes = auth.grant_scopes(found_user.scopes, requested)
+            # A request naming only admin is granted the defaults as well
+            if not set(requested) <= set(scopes):
+                return Response(statusCode=400,
+                                body={"reason": "invalid scope"})
+
+        token = utils.generate_token(found_user, scopes)
 
         return Response(statusCode=200, body={"token": token})
 
-    res = asyncio.run(_login(event))
+    res = runtime.run(_login(event))
     return res.dict()
@@ -1,4 +1,3 @@
-import asyncio
 import json
 from datetime import datetime
 
@@ -7,15 +6,37 @@ import pydantic
 from ulid import ULID
 
 import utils
-from models import serialize_datetime
-from models.posts import (Post, PostDocument, ReplyDocument, get_recent_posts,
-                          make_replies_tree)
+from config import get_config
+from models.categories import (MAX_TOP_CATEGORIES_LIMIT, TOP_CATEGORIES_LIMIT,
+                               get_top_categories, update_category_counts)
+from models.comments import (COMMENTS_PAGE_SIZE, MAX_COMMENTS_PAGE_SIZE,
+                             CommentCreate, CommentDocument, add_comment,
+                             delete_comment, delete_post_comments,
+                             find_comment, get_comments, set_comment_like)
+from models.follows import get_all_followers
+from models.likes import (LIKES_PAGE_SIZE, MAX_LIKES_PAGE_SIZE,
+                          RECONCILE_WINDOW, delete_post_likes, get_likers,
+                          has_liked, like_post, reconcile_like_counts,
+                          unlike_post)
+from models.posts import (FEED_PAGE_SIZE, MAX_FEED_PAGE_SIZE, POST_FIELDS,
+                          PostBase, PostCreate, PostDocument, PostUpdate,
+                          delete_embedded_reply, find_embedded_reply,
+                          get_category_posts, get_recent_posts,
+                          post_projection, set_embedded_reply_like)
+from models.serialization import dumps, fields_of
+from models.timelines import fan_out_post, get_timeline_posts
 from models.users import UserDocument
+from utils import runtime
 from utils.logging import LOG_MANAGER
+from utils.responses import http_response
 
 logger = LOG_MANAGER.getLogger(__name__)
 
+# Fields clients can select with ?fields= on a single post
+POST_DETAIL_FIELDS = POST_FIELDS | {"liked"}
 
+
+@http_response
 def index(event, context):
     """
     Get recent posts from the user's following list
@@ -35,46 +56,42 @@ def index(event, context):
         if not user:
             return {"statusCode": 404, "body": "User not found"}
 
-        if ("queryStringParameters" in event and
-                event["queryStringParameters"] and
-                "category" in event["queryStringParameters"]):
-            posts = await PostDocument.find(
-                PostDocument.categories == event["queryStringParameters"]
-                ["category"]).to_list()
+        try:
+            cursor, limit = utils.get_page_params(event, FEED_PAGE_SIZE,
+                                                  MAX_FEED_PAGE_SIZE)
+            fields = utils.get_fields(event, POST_FIELDS)
+        except ValueError as e:
             return {
-                "statusCode":
-                    200,
-                "body":
-                    json.dumps(
-                        {
-                            "posts": [
-                                Post(**post.dict(exclude={"replies"}),
-                                     replies=make_replies_tree(
-                                         post.replies)).dict() for post in posts
-                            ]
-                        },
-                        default=serialize_datetime,
-                    ),
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
             }
 
-        posts = await get_recent_posts(user)
+        projection = post_projection(fields) if fields else PostBase
+        category = (event.get("queryStringParameters") or {}).get("category")
+        settings = get_config()
+        if category:
+            posts, next_cursor = await get_category_posts(
+                category, cursor, limit, projection)
+        elif settings.feed_mode == "fanout":
+            posts, next_cursor = await get_timeline_posts(
+                user, cursor, limit, settings.fanout_follower_threshold,
+                settings.timeline_max_length, projection)
+        else:
+            posts, next_cursor = await get_recent_posts(user, cursor, limit,
+                                                        projection)
         return {
             "statusCode":
                 200,
             "body":
-                json.dumps(
+                dumps(
                     {
-                        "posts": [
-                            Post(**post.dict(exclude={"replies"}),
-                                 replies=make_replies_tree(
-                                     post.replies)).dict() for post in posts
-                        ]
+                        "posts": posts,
+                        "next_cursor": next_cursor,
                     },
-                    default=serialize_datetime,
                 ),
         }
 
-    return asyncio.run(_index(username))
+    return runtime.run(_index(username))
 
 
 def create(event, context):
@@ -94,53 +111,144 @@ def create(event, context):
         try:
             body = json.loads(event["body"])
         except KeyError:
-            return {"statusCode": 400, "body": json.dumps("No body was passed")}
+            return {"statusCode": 400, "body": dumps("No body was passed")}
 
         try:
-            new_post = PostDocument(**body, author=username, ulid=str(ULID()))
+            # Counters and replies are left to their defaults, clients only
+            # set the fields of PostCreate
+            new_post = PostDocument(**PostCreate.parse_obj(body).dict(),
+                                    author=username,
+                                    ulid=str(ULID()))
             await new_post.save()
         except pydantic.ValidationError as e:
-            logger.error(f"{new_post} caused a validation error: {e.errors()}",
+            logger.error(f"{body} caused a validation error: {e.errors()}",
                          extra={})
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
-        return {"statusCode": 200, "body": Post(**new_post.dict()).json()}
+        settings = get_config()
+        if settings.feed_mode == "fanout":
+            author = await UserDocument.find_one(
+                UserDocument.username == username)
+            followers = []
+            # Followers of celebrity accounts read their posts at feed time
+            if (author and author.follower_count <=
+                    settings.fanout_follower_threshold):
+                followers = await get_all_followers(username)
+            await fan_out_post(new_post, [username, *followers],
+                               settings.timeline_max_length)
+
+        await update_category_counts(new_post.categories, [])
 
-    return asyncio.run(_create(event, username))
+        return {"statusCode": 200, "body": dumps(new_post)}
 
+    return runtime.run(_create(event, username))
 
+
+@http_response
 def get(event, context):
 
     async def _get(event):
+        try:
+            username = utils.get_current_user(event, context)
+        except KeyError:
+            return {
+                "statusCode": 403,
+                "body": "Unauthorized: No token was passed"
+            }
+        except jwt.exceptions.InvalidSignatureError:
+            return {"statusCode": 403, "body": "Unauthorized: Invalid token"}
+
+        try:
+            fields = utils.get_fields(event, POST_DETAIL_FIELDS)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
+            }
+
         await utils.setup()
         logger.info(f"Getting post {event['pathParameters']['id']}", extra={})
         try:
             _id = event["pathParameters"]["id"]
-            post = await PostDocument.find_one(PostDocument.ulid == _id)
+            # Comments are paged through /posts/{id}/comments
+            projection = (post_projection(fields - {"liked"})
+                          if fields else PostBase)
+            post = await PostDocument.find_one(
+                PostDocument.ulid == _id).project(projection)
         except KeyError:
             return {
                 "statusCode":
                     400,
                 "body":
-                    json.dumps(
+                    dumps(
                         {"message": "Path parameter 'id' was not passed"}),
             }
 
         if not post:
             return {"statusCode": 404, "body": "Post not found"}
 
+        body = fields_of(post)
+        if not fields or "liked" in fields:
+            body["liked"] = await has_liked(post.ulid, username)
+
+        return {
+            "statusCode": 200,
+            "body": dumps(body),
+        }
+
+    return runtime.run(_get(event))
+
+
+@http_response
+def likes(event, context):
+    """
+    Page through the users who liked a post
+    """
+
+    async def _likes(event):
+        await utils.setup()
+
+        post_id = event["pathParameters"]["id"]
+        try:
+            cursor, limit = utils.get_page_params(event, LIKES_PAGE_SIZE,
+                                                  MAX_LIKES_PAGE_SIZE)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
+            }
+
+        usernames, next_cursor = await get_likers(post_id, cursor, limit)
         return {
             "statusCode":
                 200,
             "body":
-                Post(**post.dict(exclude={"replies"}),
-                     replies=make_replies_tree(post.replies)).json()
+                dumps({
+                    "likes": usernames,
+                    "next_cursor": next_cursor
+                }),
         }
 
-    return asyncio.run(_get(event))
+    return runtime.run(_likes(event))
+
+
+def reconcile_likes(event, context):
+    """
+    Scheduled job that repairs drift between posts' like_count and the likes
+    collection
+    """
+
+    async def _reconcile_likes():
+        await utils.setup()
+        corrected = await reconcile_like_counts(since=datetime.utcnow() -
+                                                RECONCILE_WINDOW)
+        logger.info(f"Reconciled like counts of {corrected} posts", extra={})
+        return {"corrected": corrected}
+
+    return runtime.run(_reconcile_likes())
 
 
 def edit(event, context):
@@ -160,7 +268,7 @@ def edit(event, context):
         try:
             body = json.loads(event["body"])
         except KeyError:
-            return {"statusCode": 400, "body": json.dumps("No body was passed")}
+            return {"statusCode": 400, "body": dumps("No body was passed")}
 
         try:
             post_ulid = event["pathParameters"]["id"]
@@ -169,7 +277,7 @@ def edit(event, context):
                 "statusCode":
                     400,
                 "body":
-                    json.dumps(
+                    dumps(
                         {"message": "Path parameter 'id' was not passed"}),
             }
 
@@ -182,27 +290,36 @@ def edit(event, context):
             if post.author != username:
                 return {"statusCode": 403, "body": "Unauthorized"}
 
-            for field, value in body.items():
-                setattr(post, field, value)
+            # Only the editable fields are written, so concurrent like count
+            # and reply updates are not overwritten with this stale copy
+            changes = PostUpdate.parse_obj(body).dict(exclude_unset=True)
+            if changes:
+                changes["updated_at"] = datetime.now()
+                await PostDocument.get_motor_collection().update_one(
+                    {"ulid": post_ulid}, {"$set": changes})
 
-            await post.save()
+            old_categories = set(post.categories)
+            for field, value in changes.items():
+                setattr(post, field, value)
+            await update_category_counts(
+                list(set(post.categories) - old_categories),
+                list(old_categories - set(post.categories)))
         except pydantic.ValidationError as e:
             logger.error(f"{post} caused a validation error: {e.errors()}",
                          extra={})
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
         return {
             "statusCode":
                 200,
             "body":
-                Post(**post.dict(exclude={"replies"}),
-                     replies=make_replies_tree(post.replies)).json()
+                dumps(fields_of(post, exclude={"replies"}))
         }
 
-    return asyncio.run(_edit(event))
+    return runtime.run(_edit(event))
 
 
 def delete(event, context):
@@ -226,7 +343,7 @@ def delete(event, context):
                 "statusCode":
                     400,
                 "body":
-                    json.dumps(
+                    dumps(
                         {"message": "Path parameter 'id' was not passed"}),
             }
 
@@ -240,17 +357,25 @@ def delete(event, context):
                 return {"statusCode": 403, "body": "Unauthorized"}
 
             await post.delete()
+            await delete_post_comments(post.ulid)
+            await delete_post_likes(post.ulid)
+            await update_category_counts([], post.categories)
         except pydantic.ValidationError as e:
             logger.error(f"{post} caused a validation error: {e.errors()}",
                          extra={})
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
-        return {"statusCode": 200, "body": Post(**post.dict()).json()}
+        return {
+            "statusCode":
+                200,
+            "body":
+                dumps(fields_of(post, exclude={"replies"}))
+        }
 
-    return asyncio.run(_delete(event))
+    return runtime.run(_delete(event))
 
 
 def like(event, context):
@@ -270,18 +395,13 @@ def like(event, context):
 
         post_id = event["pathParameters"]["id"]
 
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
+        like_count = await like_post(post_id, username)
+        if like_count is None:
             return {"statusCode": 404, "body": "Post not found"}
 
-        if username in post.likes:
-            return {"statusCode": 200}
-
-        post.likes.append(username)
-        await post.save()
-        return {"statusCode": 200}
+        return {"statusCode": 200, "body": dumps({"like_count": like_count})}
 
-    return asyncio.run(_like(event))
+    return runtime.run(_like(event))
 
 
 def comment_like(event, context):
@@ -300,25 +420,26 @@ def comment_like(event, context):
         await utils.setup()
 
         post_id = event["pathParameters"]["id"]
-        comment_id = event["pathParameters"]["comment_id"]
-
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
-            return {"statusCode": 404, "body": "Post not found"}
+        comment_id = event["pathParameters"]["commentId"]
 
-        comment = next(
-            filter(lambda reply: reply.ulid == comment_id, post.replies), None)
-        if not comment:
-            return {"statusCode": 404, "body": "Comment not found"}
+        comment = await find_comment(post_id, comment_id)
+        if comment:
+            await set_comment_like(comment, username, liked=True)
+            return {"statusCode": 200}
 
-        if username in comment.likes:
+        # Comments made before the comments collection are embedded in the post
+        if await set_embedded_reply_like(post_id,
+                                         comment_id,
+                                         username,
+                                         liked=True):
             return {"statusCode": 200}
 
-        comment.likes.append(username)
-        await post.save()
-        return {"statusCode": 200}
+        post_found, _ = await find_embedded_reply(post_id, comment_id)
+        if not post_found:
+            return {"statusCode": 404, "body": "Post not found"}
+        return {"statusCode": 404, "body": "Comment not found"}
 
-    return asyncio.run(_comment_like(event))
+    return runtime.run(_comment_like(event))
 
 
 def comment_unlike(event, context):
@@ -337,25 +458,26 @@ def comment_unlike(event, context):
         await utils.setup()
 
         post_id = event["pathParameters"]["id"]
-        comment_id = event["pathParameters"]["comment_id"]
-
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
-            return {"statusCode": 404, "body": "Post not found"}
+        comment_id = event["pathParameters"]["commentId"]
 
-        comment = next(
-            filter(lambda reply: reply.ulid == comment_id, post.replies), None)
-        if not comment:
-            return {"statusCode": 404, "body": "Comment not found"}
+        comment = await find_comment(post_id, comment_id)
+        if comment:
+            await set_comment_like(comment, username, liked=False)
+            return {"statusCode": 200}
 
-        if username not in comment.likes:
+        # Comments made before the comments collection are embedded in the post
+        if await set_embedded_reply_like(post_id,
+                                         comment_id,
+                                         username,
+                                         liked=False):
             return {"statusCode": 200}
 
-        comment.likes.remove(username)
-        await post.save()
-        return {"statusCode": 200}
+        post_found, _ = await find_embedded_reply(post_id, comment_id)
+        if not post_found:
+            return {"statusCode": 404, "body": "Post not found"}
+        return {"statusCode": 404, "body": "Comment not found"}
 
-    return asyncio.run(_comment_unlike(event))
+    return runtime.run(_comment_unlike(event))
 
 
 def unlike(event, context):
@@ -375,18 +497,13 @@ def unlike(event, context):
 
         post_id = event["pathParameters"]["id"]
 
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
+        like_count = await unlike_post(post_id, username)
+        if like_count is None:
             return {"statusCode": 404, "body": "Post not found"}
 
-        if username not in post.likes:
-            return {"statusCode": 200}
-
-        post.likes.remove(username)
-        await post.save()
-        return {"statusCode": 200}
+        return {"statusCode": 200, "body": dumps({"like_count": like_count})}
 
-    return asyncio.run(_unlike(event))
+    return runtime.run(_unlike(event))
 
 
 def comment(event, context):
@@ -406,30 +523,31 @@ def comment(event, context):
 
         post_id = event["pathParameters"]["id"]
 
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
+        if not await PostDocument.find(PostDocument.ulid == post_id).count():
             return {"statusCode": 404, "body": "Post not found"}
-        
 
         try:
             logger.info(f"Commenting on post {post_id}: {event['body']}", extra={})
-            # If the body contains the parent_ulid, it's a reply
-            reply = ReplyDocument(**json.loads(event["body"]),
-                              author=username,
-                              ulid=str(ULID()))
+            # If the body contains the parent_ulid, it's a reply. Counters
+            # and likes are left to their defaults.
+            fields = CommentCreate.parse_obj(json.loads(event["body"]))
+            reply = CommentDocument(**fields.dict(),
+                                    author=username,
+                                    post_ulid=post_id,
+                                    ulid=str(ULID()))
         except KeyError:
             return {"statusCode": 400, "body": "No body was passed"}
         except pydantic.ValidationError as e:
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
-        post.replies.append(reply)
-        await post.save()
-        return {"statusCode": 200, "body": reply.json()}
+        if not await add_comment(reply):
+            return {"statusCode": 404, "body": "Parent comment not found"}
+        return {"statusCode": 200, "body": dumps(reply)}
 
-    return asyncio.run(_comment(event))
+    return runtime.run(_comment(event))
 
 
 def comment_delete(event, context):
@@ -450,20 +568,85 @@ def comment_delete(event, context):
         post_id = event["pathParameters"]["id"]
         comment_id = event["pathParameters"]["commentId"]
 
-        post = await PostDocument.find_one(PostDocument.ulid == post_id)
-        if not post:
-            return {"statusCode": 404, "body": "Post not found"}
+        comment = await find_comment(post_id, comment_id)
+        if comment:
+            if comment.author != username:
+                return {"statusCode": 403, "body": "Unauthorized"}
+            await delete_comment(comment)
+            return {"statusCode": 200}
 
-        comment = next(
-            filter(lambda reply: reply.ulid == comment_id, post.replies), None)
-        if not comment:
+        # Comments made before the comments collection are embedded in the post
+        if await delete_embedded_reply(post_id, comment_id, username):
+            return {"statusCode": 200}
+
+        post_found, reply = await find_embedded_reply(post_id, comment_id)
+        if not post_found:
+            return {"statusCode": 404, "body": "Post not found"}
+        if not reply:
             return {"statusCode": 404, "body": "Comment not found"}
+        return {"statusCode": 403, "body": "Unauthorized"}
+
+    return runtime.run(_comment_delete(event))
+
+
+@http_response
+def comments(event, context):
+    """
+    Page through the comments of a post. Pass ``parent`` to load the replies
+    to a comment instead of the top-level comments.
+    """
+
+    async def _comments(event):
+        await utils.setup()
+
+        post_id = event["pathParameters"]["id"]
+        parent_ulid = (event.get("queryStringParameters") or
+                       {}).get("parent", "")
+        try:
+            cursor, limit = utils.get_page_params(event, COMMENTS_PAGE_SIZE,
+                                                  MAX_COMMENTS_PAGE_SIZE)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
+            }
+
+        page, next_cursor = await get_comments(post_id, parent_ulid, cursor,
+                                               limit)
+        return {
+            "statusCode":
+                200,
+            "body":
+                dumps(
+                    {
+                        "comments": page,
+                        "next_cursor": next_cursor,
+                    },
+                ),
+        }
+
+    return runtime.run(_comments(event))
+
+
+@http_response
+def categories(event, context):
+    """
+    Get the categories with the most posts
+    """
 
-        if comment.author != username:
-            return {"statusCode": 403, "body": "Unauthorized"}
+    async def _categories(event):
+        await utils.setup()
+        try:
+            limit = int((event.get("queryStringParameters") or
+                         {}).get("limit", TOP_CATEGORIES_LIMIT))
+        except ValueError:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": "limit must be an integer"})
+            }
 
-        post.replies.remove(comment)
-        await post.save()
-        return {"statusCode": 200}
+        top = await get_top_categories(
+            max(1, min(limit, MAX_TOP_CATEGORIES_LIMIT)))
+        return {"statusCode": 200, "body": dumps({"categories": top})}
 
-    return asyncio.run(_comment_delete(event))
+    return runtime.run(_categories(event))
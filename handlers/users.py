@@ -1,16 +1,35 @@
-import asyncio
 import json
 
 import pydantic
+from pymongo import ReturnDocument
 
 import utils
-from models import serialize_datetime
-from models.posts import Post, PostDocument
-from models.users import User, UserDocument, UserUpdate, generate_user_dict
+from config import get_config
+from models.follows import (FOLLOWS_PAGE_SIZE, MAX_FOLLOWS_PAGE_SIZE,
+                            FollowCounts, UserNotFound, follow_user,
+                            generate_user_dict, get_followers, get_following,
+                            unfollow_user)
+from models.posts import PostBase, PostDocument
+from models.serialization import dumps, fields_of
+from models.timelines import add_to_timeline, remove_from_timeline
+from models.users import (PRIVATE_FIELDS, UserDocument, UserIn, UserLoader,
+                          UserSummary, UserUpdate, profile_projection)
+from utils import auth, runtime
 from utils.logging import LOG_MANAGER
+from utils.responses import http_response
 
 logger = LOG_MANAGER.getLogger(__name__)
 
+# Fields clients can select with ?fields= on a profile
+PROFILE_FIELDS = frozenset({
+    "username", "avatar", "followers", "following", "follower_count",
+    "following_count", "posts"
+})
+# Follower and following lists are only expanded when asked for, the
+# paginated endpoints serve the full lists
+RELATIONSHIP_FIELDS = frozenset({"followers", "following"})
+DEFAULT_PROFILE_FIELDS = PROFILE_FIELDS - RELATIONSHIP_FIELDS
+
 
 def create(event, context):
     """
@@ -23,15 +42,21 @@ def create(event, context):
         try:
             body = json.loads(event["body"])
         except KeyError:
-            return {"statusCode": 400, "body": json.dumps("No body was passed")}
+            return {"statusCode": 400, "body": dumps("No body was passed")}
 
         try:
-            new_user = UserDocument.parse_obj(body)
+            # Only the credentials and avatar come from the client. Scopes,
+            # counters and the token version keep their defaults
+            credentials = UserIn.parse_obj(body)
+            new_user = UserDocument(
+                username=credentials.username,
+                password=credentials.password.get_secret_value(),
+                avatar=body.get("avatar"))
             if await UserDocument.find_one(
                     UserDocument.username == new_user.username):
                 return {
                     "statusCode": 400,
-                    "body": json.dumps({"reason": "username already exists"}),
+                    "body": dumps({"reason": "username already exists"}),
                 }
             logger.info(
                 f"Creating user '{new_user.username}'",
@@ -41,46 +66,35 @@ def create(event, context):
         except pydantic.ValidationError as e:
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
         return {
             "statusCode": 200,
-            "body": json.dumps({"token": utils.generate_token(new_user)}),
+            "body": dumps({"token": utils.generate_token(new_user)}),
         }
 
-    return asyncio.run(_create(event))
+    return runtime.run(_create(event))
 
 
+@http_response
 def index(event, context):
 
     async def _index():
         await utils.setup()
         logger.info("Getting all users")
-        users = await UserDocument.find_all(limit=100,
-                                            sort=[("username", 1)]).to_list()
-
-        users = await asyncio.gather(
-            *[generate_user_dict(user) for user in users],)
-        print(f"Users: {users}")
+        users = await UserDocument.find_all(
+            limit=100, sort=[("username", 1)]).project(UserSummary).to_list()
         logger.info(f"Found {len(users)} users", extra={})
 
-        logger.info(
-            f"Users converted to dicts: {[User(**user).dict(exclude={'password', 'scopes'}) for user in users]}",
-            extra={})
         return {
             "statusCode":
                 200,
             "body":
-                json.dumps({
-                    "users": [
-                        User(**user).dict(exclude={"password", "scopes"})
-                        for user in users
-                    ]
-                }),
+                dumps({"users": users}),
         }
 
-    return asyncio.run(_index())
+    return runtime.run(_index())
 
 
 def edit(event, context):
@@ -90,21 +104,12 @@ def edit(event, context):
         try:
             body = json.loads(event["body"])
         except KeyError:
-            return {"statusCode": 400, "body": json.dumps("No body was passed")}
+            return {"statusCode": 400, "body": dumps("No body was passed")}
 
         username = event["pathParameters"]["username"]
 
         try:
-            user = UserUpdate.parse_obj(body)
-            user_doc = await UserDocument.find_one(
-                UserDocument.username == username)
-            logger.info(
-                f"Updated user {username} with {body}",
-                extra={},
-            )
-            for field, value in user.dict(exclude_unset=True):
-                setattr(user_doc, field, value)
-            await user_doc.save()
+            changes = UserUpdate.parse_obj(body).dict(exclude_unset=True)
         except pydantic.ValidationError as e:
             logger.error(
                 f"Failed to update user {username}: {e}",
@@ -112,23 +117,61 @@ def edit(event, context):
             )
             return {
                 "statusCode": 400,
-                "body": json.dumps({"reason": e.errors()})
+                "body": dumps({"reason": e.errors()})
             }
 
-        return {
-            "statusCode": 200,
-            "body": User(**user.dict(exclude={'password'})).json(),
-        }
+        for field, value in changes.items():
+            if isinstance(value, pydantic.SecretStr):
+                changes[field] = value.get_secret_value()
+        # Only the changed profile fields are written, so follow counters,
+        # the following list and the token version updated concurrently
+        # are not overwritten
+        users = UserDocument.get_motor_collection()
+        projection = {field: 0 for field in PRIVATE_FIELDS}
+        if changes:
+            user = await users.find_one_and_update(
+                {"username": username}, {"$set": changes},
+                projection=projection,
+                return_document=ReturnDocument.AFTER)
+        else:
+            user = await users.find_one({"username": username},
+                                        projection=projection)
+        if user is None:
+            return {"statusCode": 404, "body": dumps("User not found")}
+        logger.info(
+            f"Updated user {username} fields {sorted(changes)}",
+            extra={},
+        )
+        if "password" in changes:
+            # Tokens issued with the old password must stop working
+            await auth.revoke_user(user["username"])
 
-    return asyncio.run(_edit(event))
+        user.pop("_id")
+        return {"statusCode": 200, "body": dumps(user)}
 
+    return runtime.run(_edit(event))
 
+
+@http_response
 def show(event, context):
 
     async def _show(event):
+        try:
+            fields = utils.get_fields(event, PROFILE_FIELDS)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
+            }
+
         await utils.setup()
         username = event["pathParameters"]["username"]
-        user = await UserDocument.find_one(UserDocument.username == username)
+        fields = fields or DEFAULT_PROFILE_FIELDS
+        # Only the requested fields are read, never the password or the
+        # full following list
+        user = await UserDocument.find_one(
+            UserDocument.username == username).project(
+                profile_projection(fields))
 
         if not user:
             logger.error(
@@ -138,135 +181,151 @@ def show(event, context):
             return {"statusCode": 404, "body": "User not found"}
 
         logger.info(f"Found user {username}", extra={})
-        logger.info(
-            f"Getting followers for {username}",
-            extra={},
-        )
-        user_dict = await generate_user_dict(user)
-
-        posts = await PostDocument.find(PostDocument.author == username,
-                                        limit=100).to_list()
+        if fields & RELATIONSHIP_FIELDS:
+            logger.info(
+                f"Getting followers for {username}",
+                extra={},
+            )
+            user_dict = await generate_user_dict(user)
+        else:
+            user_dict = fields_of(user)
+
+        body = {
+            "user": {
+                name: value
+                for name, value in user_dict.items()
+                if name in fields
+            }
+        }
 
-        posts = [Post(**post.dict()).dict() for post in posts]
+        if "posts" in fields:
+            posts = await PostDocument.find(
+                PostDocument.author == username).sort(-PostDocument.ulid).limit(
+                    100).project(PostBase).to_list()
+            body["posts"] = posts
 
         return {
-            "statusCode":
-                200,
-            "body":
-                json.dumps(
-                    {
-                        "user":
-                            User(**user_dict
-                                ).dict(exclude={"password", "scopes"}),
-                        "posts":
-                            posts
-                    },
-                    default=serialize_datetime),
+            "statusCode": 200,
+            "body": dumps(body),
         }
 
-    return asyncio.run(_show(event))
+    return runtime.run(_show(event))
 
 
 def follow(event, context):
+    """
+    Follow a user, returning their follower count and the caller's following
+    count
+    """
+    return _follow_change(event, context, "follow", follow_user,
+                          _add_followee_posts)
 
-    async def _follow(event):
-        await utils.setup()
 
-        follower = utils.get_current_user(event, context)
+def unfollow(event, context):
+    """
+    Unfollow a user, returning their follower count and the caller's
+    following count
+    """
+    return _follow_change(event, context, "unfollow", unfollow_user,
+                          _remove_followee_posts)
+
+
+async def _add_followee_posts(follower: str, username: str,
+                              counts: FollowCounts):
+    settings = get_config()
+    # Posts of celebrity accounts are read at feed time instead
+    if counts.follower_count <= settings.fanout_follower_threshold:
+        await add_to_timeline(follower, username,
+                              settings.timeline_max_length)
+
+
+async def _remove_followee_posts(follower: str, username: str,
+                                 counts: FollowCounts):
+    await remove_from_timeline(follower, username)
 
-        follower = await UserDocument.find_one(UserDocument.username == follower
-                                              )
 
-        if not follower:
-            return {"statusCode": 404, "body": "User in request not found"}
+def _follow_change(event, context, action: str, change, update_timeline):
 
+    async def _change(event):
+        await utils.setup()
+
+        follower = utils.get_current_user(event, context)
         username = event["pathParameters"]["username"]
-        follow_user = await UserDocument.find_one(
-            UserDocument.username == username)
 
-        if not follow_user:
-            return {"statusCode": 404, "body": "User not found"}
+        if follower == username:
+            return {"statusCode": 400, "body": f"Cannot {action} yourself"}
 
         logger.info(
-            f"User '{follower.username}' wants to follow {follow_user.username}",
+            f"User '{follower}' wants to {action} {username}",
             extra={},
         )
+        try:
+            counts = await change(follower, username)
+        except UserNotFound:
+            return {"statusCode": 404, "body": "User not found"}
 
-        if follower == username:
-            return {"statusCode": 400, "body": "Cannot follow yourself"}
-
-        if follower.username in follow_user.followers:
+        if not counts.changed:
             logger.info(
-                f"User '{follower.username}' already follows '{follow_user.username}'",
+                f"Follow from '{follower}' to '{username}' already up to date",
                 extra={},
             )
-            return {"statusCode": 200, "body": json.dumps({})}
-
-        follow_user.followers.append(follower.username)
-
-        await follow_user.save()
-
-        follower.following.append(follow_user.username)
-
-        await follower.save()
-        user_dict = await generate_user_dict(follow_user)
-
+        elif get_config().feed_mode == "fanout":
+            await update_timeline(follower, username, counts)
         return {
-            "statusCode": 200,
-            "body": User(**user_dict).json(),
+            "statusCode":
+                200,
+            "body":
+                dumps({
+                    "follower_count": counts.follower_count,
+                    "following_count": counts.following_count,
+                }),
         }
 
-    return asyncio.run(_follow(event))
+    return runtime.run(_change(event))
 
 
-def unfollow(event, context):
-
-    async def _unfollow(event):
-        await utils.setup()
-
-        follower = utils.get_current_user(event, context)
-
-        follower = await UserDocument.find_one(UserDocument.username == follower
-                                              )
+def _relationships(event, context, get_page):
 
-        if not follower:
-            return {"statusCode": 404, "body": "User in request not found"}
+    async def _page(event):
+        try:
+            cursor, limit = utils.get_page_params(event, FOLLOWS_PAGE_SIZE,
+                                                  MAX_FOLLOWS_PAGE_SIZE)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": dumps({"reason": str(e)})
+            }
 
+        await utils.setup()
         username = event["pathParameters"]["username"]
-        follow_user = await UserDocument.find_one(
-            UserDocument.username == username)
-
-        if not follow_user:
+        if not await UserDocument.find_one(UserDocument.username == username):
             return {"statusCode": 404, "body": "User not found"}
 
-        if follower == username:
-            return {"statusCode": 400, "body": "Cannot unfollow yourself"}
-
-        if follower.username not in follow_user.followers:
-            logger.info(
-                f"User '{follower.username}' does not follow {follow_user.username}",
-                extra={},
-            )
-            return {"statusCode": 200, "body": json.dumps({})}
-
-        logger.info(
-            f"User '{follower.username}' wants to unfollow {follow_user.username}",
-            extra={},
-        )
-
-        follow_user.followers.remove(follower.username)
-
-        await follow_user.save()
+        usernames, next_cursor = await get_page(username, cursor, limit)
+        return {
+            "statusCode":
+                200,
+            "body":
+                dumps({
+                    "users": await UserLoader().load_many(usernames),
+                    "next_cursor": next_cursor
+                }),
+        }
 
-        follower.following.remove(follow_user.username)
+    return runtime.run(_page(event))
 
-        await follower.save()
 
-        user_dict = await generate_user_dict(follow_user)
+@http_response
+def followers(event, context):
+    """
+    Get one page of a user's followers, most recent first
+    """
+    return _relationships(event, context, get_followers)
 
-        return {
-            "statusCode": 200,
-            "body": User(**user_dict).json(),
-        }
 
-    return asyncio.run(_unfollow(event))
+@http_response
+def following(event, context):
+    """
+    Get one page of the users a user follows, most recent first
+    """
+    return _relationships(event, context, get_following)
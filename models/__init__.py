@@ -1,10 +1,11 @@
-import json
 from datetime import datetime
-from typing import Union
+from typing import Iterable, Type, Union
 
 from beanie import Document
 from bson import ObjectId
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, create_model, validator
+
+from models.serialization import dumps
 
 
 class BaseDocument(Document):
@@ -32,16 +33,23 @@ class Response(BaseModel):
 
     @validator('body')
     def body_must_be_valid(cls, v):
-        if isinstance(v, BaseModel):
-            return v.json()
         if isinstance(v, str):
             return v
-        if isinstance(v, dict):
-            return json.dumps(v)
+        if isinstance(v, (BaseModel, dict)):
+            return dumps(v)
         raise ValueError("Body must be a string or a BaseModel")
 
 
-def serialize_datetime(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError(f"Type {type(obj)} not serializable")
+def make_projection(model: Type[BaseModel],
+                    fields: Iterable[str]) -> Type[BaseModel]:
+    """Build a model with only some of ``model``'s fields.
+
+    Passed to Beanie's ``project()`` it limits what Mongo returns to those
+    fields, for sparse fieldset requests.
+    """
+    return create_model(
+        f"{model.__name__}Projection", **{
+            name: (field.annotation, ... if field.required else field.default)
+            for name, field in model.__fields__.items()
+            if name in fields
+        })
@@ -0,0 +1,117 @@
+from pymongo import UpdateOne
+
+from models import BaseDocument
+from models.posts import PostDocument
+from utils.cache import TTLCache
+
+TOP_CATEGORIES_LIMIT = 20
+MAX_TOP_CATEGORIES_LIMIT = 100
+
+_top_categories = TTLCache(ttl=60, maxsize=8)
+
+
+class CategoryDocument(BaseDocument):
+    """Number of posts in a category, maintained as posts change"""
+    name: str
+    post_count: int = 0
+
+    class Settings:
+        name = "categories"
+
+
+async def update_category_counts(added: list[str], removed: list[str]):
+    """Adjust the post counts of categories a post was added to or left"""
+    changes = {}
+    for category in set(added):
+        changes[category] = changes.get(category, 0) + 1
+    for category in set(removed):
+        changes[category] = changes.get(category, 0) - 1
+    updates = [
+        UpdateOne({"name": name}, {"$inc": {
+            "post_count": change
+        }}, upsert=True)
+        for name, change in changes.items()
+        if change
+    ]
+    if updates:
+        collection = CategoryDocument.get_motor_collection()
+        await collection.bulk_write(updates, ordered=False)
+
+
+async def recount_categories() -> int:
+    """Set the post count of every category from the posts collection.
+
+    Counts posts created before categories were counted, and repairs counts
+    that drifted. Each write only applies if the count still holds the value
+    that was read, so a concurrent post is not undone. Returns the number of
+    categories fixed.
+    """
+    grouped = PostDocument.get_motor_collection().aggregate([
+        # A category listed twice on a post is counted once, as on writes
+        {
+            "$project": {
+                "categories": {
+                    "$setUnion": ["$categories", []]
+                }
+            }
+        },
+        {
+            "$unwind": "$categories"
+        },
+        {
+            "$group": {
+                "_id": "$categories",
+                "count": {
+                    "$sum": 1
+                }
+            }
+        },
+    ])
+    counts = {row["_id"]: row["count"] async for row in grouped}
+
+    collection = CategoryDocument.get_motor_collection()
+    updates = []
+    async for category in collection.find({},
+                                          projection={
+                                              "name": 1,
+                                              "post_count": 1
+                                          }):
+        count = counts.pop(category["name"], 0)
+        if category.get("post_count") != count:
+            updates.append(
+                UpdateOne(
+                    {
+                        "_id": category["_id"],
+                        "post_count": category.get("post_count")
+                    }, {"$set": {
+                        "post_count": count
+                    }}))
+    # Categories only old posts are in have no document yet
+    updates.extend(
+        UpdateOne({"name": name}, {"$setOnInsert": {
+            "post_count": count
+        }}, upsert=True)
+        for name, count in counts.items())
+    if updates:
+        await collection.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+async def get_top_categories(limit: int) -> list[dict]:
+    """Get the categories with the most posts, cached for a minute"""
+    categories = _top_categories.get(limit)
+    if categories is None:
+        categories = await CategoryDocument.get_motor_collection().find(
+            {
+                "post_count": {
+                    "$gt": 0
+                }
+            },
+            projection={
+                "_id": 0,
+                "name": 1,
+                "post_count": 1
+            },
+        ).sort("post_count", -1).limit(limit).to_list(length=limit)
+        _top_categories.set(limit, categories)
+    return categories
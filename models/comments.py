@@ -0,0 +1,152 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne
+
+from models import BaseDocument
+from models.posts import PostDocument, ReplyDocument
+
+COMMENTS_PAGE_SIZE = 20
+MAX_COMMENTS_PAGE_SIZE = 100
+
+
+class Comment(ReplyDocument):
+    post_ulid: str
+    reply_count: int = 0
+
+
+class CommentCreate(BaseModel):
+    """The fields a client sets when commenting, a parent makes it a reply"""
+    content: str
+    parent_ulid: str = ""
+
+
+class CommentDocument(BaseDocument, Comment):
+    """A comment stored on its own instead of inside the post document.
+
+    Top-level comments have an empty ``parent_ulid``. ``reply_count`` lets
+    clients decide whether to load a comment's replies.
+    """
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+    class Settings:
+        name = "comments"
+
+
+async def add_comment(comment: CommentDocument) -> bool:
+    """Insert a comment, returning False when its parent does not exist"""
+    if comment.parent_ulid:
+        parent = await CommentDocument.get_motor_collection().update_one(
+            {
+                "ulid": comment.parent_ulid,
+                "post_ulid": comment.post_ulid
+            }, {"$inc": {
+                "reply_count": 1
+            }})
+        if not parent.matched_count:
+            return False
+    await comment.insert()
+    return True
+
+
+async def get_comments(post_ulid: str, parent_ulid: str, cursor: Optional[str],
+                       limit: int) -> tuple[list[Comment], Optional[str]]:
+    """Get one page of the comments under a post or a parent comment.
+
+    Comments are returned oldest first, the cursor is the ULID of the last
+    comment on the previous page.
+    """
+    query = CommentDocument.find(CommentDocument.post_ulid == post_ulid,
+                                 CommentDocument.parent_ulid == parent_ulid)
+    if cursor:
+        query = query.find(CommentDocument.ulid > cursor)
+    # Fetch one extra comment to know whether there is a next page
+    query = query.sort(+CommentDocument.ulid).limit(limit + 1)
+    comments = await query.project(Comment).to_list()
+    next_cursor = comments[limit - 1].ulid if len(comments) > limit else None
+    return comments[:limit], next_cursor
+
+
+async def find_comment(post_ulid: str,
+                       comment_ulid: str) -> Optional[CommentDocument]:
+    return await CommentDocument.find_one(
+        CommentDocument.ulid == comment_ulid,
+        CommentDocument.post_ulid == post_ulid)
+
+
+async def set_comment_like(comment: CommentDocument, username: str,
+                           liked: bool):
+    """Add or remove a user's like on a single comment record"""
+    operator = "$addToSet" if liked else "$pull"
+    await CommentDocument.get_motor_collection().update_one(
+        {"_id": comment.id}, {operator: {
+            "likes": username
+        }})
+
+
+async def delete_comment(comment: CommentDocument):
+    await comment.delete()
+    if comment.parent_ulid:
+        await CommentDocument.get_motor_collection().update_one(
+            {
+                "ulid": comment.parent_ulid,
+                "post_ulid": comment.post_ulid
+            }, {"$inc": {
+                "reply_count": -1
+            }})
+
+
+async def delete_post_comments(post_ulid: str):
+    await CommentDocument.find(CommentDocument.post_ulid == post_ulid).delete()
+
+
+async def migrate_embedded_comments() -> int:
+    """Move replies still embedded in post documents into the comments
+    collection, so a thread is served and extended from one place.
+
+    Comments keep their ULIDs, so likes, deletes and replies address them as
+    before. Returns the number of posts migrated.
+    """
+    posts = PostDocument.get_motor_collection()
+    migrated = 0
+    legacy_posts = posts.find({"replies.0": {
+        "$exists": True
+    }},
+                              projection={
+                                  "ulid": 1,
+                                  "replies": 1
+                              })
+    async for post in legacy_posts:
+        replies = [ReplyDocument.parse_obj(reply) for reply in post["replies"]]
+        reply_counts: dict[str, int] = {}
+        for reply in replies:
+            if reply.parent_ulid:
+                reply_counts[reply.parent_ulid] = (
+                    reply_counts.get(reply.parent_ulid, 0) + 1)
+        await CommentDocument.get_motor_collection().bulk_write(
+            [
+                UpdateOne(
+                    {
+                        "post_ulid": post["ulid"],
+                        "ulid": reply.ulid
+                    },
+                    {
+                        "$setOnInsert": {
+                            **reply.dict(exclude={"ulid"}),
+                            "reply_count": reply_counts.get(reply.ulid, 0),
+                        }
+                    },
+                    upsert=True,
+                ) for reply in replies
+            ],
+            ordered=False,
+        )
+        await posts.update_one({"_id": post["_id"]},
+                               {"$unset": {
+                                   "replies": ""
+                               }})
+        migrated += 1
+    return migrated
+
@@ -0,0 +1,367 @@
+import asyncio
+import weakref
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from ulid import ULID
+
+from models import BaseDocument
+from models.serialization import fields_of
+from models.users import PRIVATE_FIELDS, UserDocument, UserLoader
+
+FOLLOWS_PAGE_SIZE = 50
+MAX_FOLLOWS_PAGE_SIZE = 200
+# Followers and following inlined in a profile when they are requested
+RELATIONSHIPS_PAGE_SIZE = 20
+
+
+class FollowDocument(BaseDocument):
+    """``follower`` following ``followee``, kept out of both user documents"""
+    ulid: str = Field(default_factory=lambda: str(ULID()))
+    follower: str
+    followee: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "follows"
+
+
+class FollowCounts(NamedTuple):
+    """Counts after a follow or unfollow"""
+    changed: bool
+    # Followers of the followee
+    follower_count: int
+    # Users the follower follows
+    following_count: int
+
+
+class UserNotFound(Exception):
+    pass
+
+
+# Whether each client's deployment is a replica set or sharded cluster
+_transaction_support: "weakref.WeakKeyDictionary[Any, bool]" = (
+    weakref.WeakKeyDictionary())
+
+
+async def _supports_transactions(client) -> bool:
+    if client not in _transaction_support:
+        hello = await client.admin.command("hello")
+        _transaction_support[client] = ("setName" in hello or
+                                        hello.get("msg") == "isdbgrid")
+    return _transaction_support[client]
+
+
+async def _increment(username: str, update: dict[str, Any],
+                     session) -> Optional[dict[str, Any]]:
+    return await UserDocument.get_motor_collection().find_one_and_update(
+        {"username": username},
+        update,
+        projection={
+            "follower_count": 1,
+            "following_count": 1
+        },
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+
+
+async def _apply(follower: str, followee: str, amount: int,
+                 session) -> FollowCounts:
+    """Write the edge change and both counters, in ``session`` if given"""
+    follows = FollowDocument.get_motor_collection()
+    if amount > 0:
+        # The unique (follower, followee) index makes a repeated follow fail
+        # here, before any counter moves
+        await FollowDocument(follower=follower,
+                             followee=followee).insert(session=session)
+    else:
+        result = await follows.delete_one(
+            {
+                "follower": follower,
+                "followee": followee
+            }, session=session)
+        if not result.deleted_count:
+            return await _get_counts(follower, followee, changed=False)
+
+    followee_counts = await _increment(
+        followee, {"$inc": {
+            "follower_count": amount
+        }}, session)
+    if followee_counts is None:
+        raise UserNotFound(followee)
+    operator = "$addToSet" if amount > 0 else "$pull"
+    follower_counts = await _increment(follower, {
+        "$inc": {
+            "following_count": amount
+        },
+        operator: {
+            "following": followee
+        }
+    }, session)
+    if follower_counts is None:
+        raise UserNotFound(follower)
+    return FollowCounts(True, followee_counts["follower_count"],
+                        follower_counts["following_count"])
+
+
+async def _get_counts(follower: str, followee: str,
+                      changed: bool) -> FollowCounts:
+    users = UserDocument.get_motor_collection().find(
+        {"username": {
+            "$in": [follower, followee]
+        }},
+        projection={
+            "username": 1,
+            "follower_count": 1,
+            "following_count": 1
+        })
+    counts = {user["username"]: user async for user in users}
+    if followee not in counts:
+        raise UserNotFound(followee)
+    return FollowCounts(changed, counts[followee].get("follower_count", 0),
+                        counts.get(follower, {}).get("following_count", 0))
+
+
+async def _change(follower: str, followee: str, amount: int) -> FollowCounts:
+    """Apply a follow (1) or unfollow (-1) and return the new counts.
+
+    On a replica set the edge and both counters change in one multi-document
+    transaction, retried on transient conflicts, so concurrent requests
+    cannot lose updates and a failure leaves nothing half applied. On a
+    standalone server the unique edge index keeps the operation idempotent
+    and a follow of or by a missing user is rolled back by hand.
+    """
+    client = FollowDocument.get_motor_collection().database.client
+
+    async def in_transaction(session):
+        return await _apply(follower, followee, amount, session)
+
+    try:
+        if await _supports_transactions(client):
+            async with await client.start_session() as session:
+                return await session.with_transaction(in_transaction)
+        try:
+            return await _apply(follower, followee, amount, None)
+        except UserNotFound as e:
+            if amount > 0:
+                await FollowDocument.get_motor_collection().delete_one({
+                    "follower": follower,
+                    "followee": followee
+                })
+                # The followee's counter only moved if the follower was the
+                # missing user
+                if e.args[0] == follower:
+                    await _increment(
+                        followee, {"$inc": {
+                            "follower_count": -amount
+                        }}, None)
+            raise
+    except DuplicateKeyError:
+        return await _get_counts(follower, followee, changed=False)
+
+
+async def follow_user(follower: str, followee: str) -> FollowCounts:
+    """Record that ``follower`` follows ``followee``.
+
+    Following twice is a no-op. Raises UserNotFound when either user does
+    not exist.
+    """
+    return await _change(follower, followee, 1)
+
+
+async def unfollow_user(follower: str, followee: str) -> FollowCounts:
+    """Remove a follow, unfollowing twice is a no-op"""
+    return await _change(follower, followee, -1)
+
+
+async def get_followers(username: str, cursor: Optional[str],
+                        limit: int) -> tuple[list[str], Optional[str]]:
+    """Get one page of a user's followers, most recent first"""
+    query = FollowDocument.find(FollowDocument.followee == username)
+    if cursor:
+        query = query.find(FollowDocument.ulid < cursor)
+    follows = await query.sort(-FollowDocument.ulid).limit(limit + 1).to_list()
+    next_cursor = follows[limit - 1].ulid if len(follows) > limit else None
+    return [follow.follower for follow in follows[:limit]], next_cursor
+
+
+async def get_following(username: str, cursor: Optional[str],
+                        limit: int) -> tuple[list[str], Optional[str]]:
+    """Get one page of the users a user follows, most recent first"""
+    query = FollowDocument.find(FollowDocument.follower == username)
+    if cursor:
+        query = query.find(FollowDocument.ulid < cursor)
+    follows = await query.sort(-FollowDocument.ulid).limit(limit + 1).to_list()
+    next_cursor = follows[limit - 1].ulid if len(follows) > limit else None
+    return [follow.followee for follow in follows[:limit]], next_cursor
+
+
+async def generate_user_dict(
+        user: BaseModel,
+        loader: Optional[UserLoader] = None,
+        limit: int = RELATIONSHIPS_PAGE_SIZE) -> dict[str, Any]:
+    """The public profile of a user, or of a projection of it, with the
+    most recent ``limit`` followers and followed users expanded
+    """
+    loader = loader or UserLoader()
+    (followers, _), (following, _) = await asyncio.gather(
+        get_followers(user.username, None, limit),
+        get_following(user.username, None, limit))
+    followers, following = await asyncio.gather(loader.load_many(followers),
+                                                loader.load_many(following))
+    return {
+        **fields_of(user, exclude=PRIVATE_FIELDS | {"following"}),
+        "followers": followers,
+        "following": following,
+    }
+
+
+async def get_all_followers(username: str) -> list[str]:
+    """Every follower of a user, for fanning out their posts"""
+    cursor = FollowDocument.get_motor_collection().find(
+        {"followee": username}, projection={
+            "_id": 0,
+            "follower": 1
+        })
+    return [follow["follower"] async for follow in cursor]
+
+
+async def migrate_embedded_follows() -> int:
+    """Move followers still stored on user documents into the follows
+    collection. Run :func:`rebuild_following` and :func:`recount_follows`
+    afterwards to make the users agree with the edges.
+
+    Returns the number of users migrated.
+    """
+    users = UserDocument.get_motor_collection()
+    follows = FollowDocument.get_motor_collection()
+    migrated = 0
+    legacy_users = users.find({"followers": {
+        "$exists": True
+    }},
+                              projection={
+                                  "username": 1,
+                                  "followers": 1
+                              })
+    async for user in legacy_users:
+        if user["followers"]:
+            await follows.bulk_write(
+                [
+                    UpdateOne(
+                        {
+                            "follower": follower,
+                            "followee": user["username"]
+                        },
+                        {
+                            "$setOnInsert": {
+                                "ulid": str(ULID()),
+                                "created_at": datetime.utcnow()
+                            }
+                        },
+                        upsert=True,
+                    ) for follower in user["followers"]
+                ],
+                ordered=False,
+            )
+        await users.update_one({"_id": user["_id"]},
+                               {"$unset": {
+                                   "followers": ""
+                               }})
+        migrated += 1
+
+    return migrated
+
+
+async def rebuild_following() -> int:
+    """Set every user's ``following`` list from the follows collection.
+
+    Legacy follows and unfollows saved the followee's followers before the
+    follower's following, so an interrupted one left the lists disagreeing.
+    The edges, migrated from the followers lists, are the record. A
+    following entry without an edge would otherwise keep that author in
+    the feed for good, since unfollow finds no edge and never pulls it.
+    Each write only applies if the list is still the one read. Returns the
+    number of users fixed.
+    """
+    grouped = FollowDocument.get_motor_collection().aggregate([{
+        "$group": {
+            "_id": "$follower",
+            "followees": {
+                "$addToSet": "$followee"
+            }
+        }
+    }])
+    followees = {row["_id"]: set(row["followees"]) async for row in grouped}
+
+    users = UserDocument.get_motor_collection()
+    updates = []
+    async for user in users.find({}, projection={
+            "username": 1,
+            "following": 1
+    }):
+        current = user.get("following")
+        expected = followees.get(user["username"], set())
+        if current is not None and set(current) == expected:
+            continue
+        # Keep the order of the entries that stay
+        following = [name for name in current or [] if name in expected]
+        following += sorted(expected - set(following))
+        updates.append(
+            UpdateOne({
+                "_id": user["_id"],
+                "following": current
+            }, {"$set": {
+                "following": following
+            }}))
+    if updates:
+        await users.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+async def recount_follows() -> int:
+    """Set both counters of every user from the follows collection.
+
+    Repairs counts that drifted or were set by a client, including those of
+    users without any edge. Each write only applies if the counter still
+    holds the value that was read, so a concurrent follow is not undone.
+    Returns the number of counters fixed.
+    """
+    users = UserDocument.get_motor_collection()
+    counts: dict[str, dict[str, int]] = {}
+    for field, key in (("follower_count", "$followee"), ("following_count",
+                                                         "$follower")):
+        grouped = FollowDocument.get_motor_collection().aggregate([{
+            "$group": {
+                "_id": key,
+                "count": {
+                    "$sum": 1
+                }
+            }
+        }])
+        counts[field] = {row["_id"]: row["count"] async for row in grouped}
+
+    updates = []
+    async for user in users.find({},
+                                 projection={
+                                     "username": 1,
+                                     "follower_count": 1,
+                                     "following_count": 1
+                                 }):
+        for field, field_counts in counts.items():
+            count = field_counts.get(user["username"], 0)
+            if user.get(field) != count:
+                updates.append(
+                    UpdateOne({
+                        "_id": user["_id"],
+                        field: user.get(field)
+                    }, {"$set": {
+                        field: count
+                    }}))
+    if updates:
+        await users.bulk_write(updates, ordered=False)
+    return len(updates)
+
@@ -0,0 +1,264 @@
+"""Index declarations for every collection, managed outside the request path.
+
+Documents do not declare indexes themselves, so ``init_beanie`` never issues
+``createIndexes`` from a Lambda. Run this module at deploy time instead:
+
+    pipenv run python -m models.indexes ensure   # create missing indexes
+    pipenv run python -m models.indexes verify   # fail if any are missing
+    pipenv run python -m models.indexes explain  # fail on collection scans
+"""
+import argparse
+import sys
+from datetime import datetime
+from typing import Any, NamedTuple, Optional, Type
+
+from beanie import Document
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from models.categories import CategoryDocument
+from models.comments import CommentDocument
+from models.follows import FollowDocument
+from models.likes import LikeDocument
+from models.posts import PostDocument
+from models.timelines import TimelineDocument
+from models.users import UserDocument
+
+INDEXES: dict[Type[Document], list[IndexModel]] = {
+    UserDocument: [
+        IndexModel([("username", ASCENDING)], unique=True),
+        # Revocation list for the stateless authorizer
+        IndexModel([("token_version", ASCENDING)]),
+    ],
+    PostDocument: [
+        IndexModel([("ulid", ASCENDING)], unique=True),
+        # Feed and profile: posts by author(s), newest first. ULIDs sort by
+        # creation time, which is what every listing orders by.
+        IndexModel([("author", ASCENDING), ("ulid", DESCENDING)]),
+        IndexModel([("categories", ASCENDING), ("ulid", DESCENDING)]),
+        # Posts the like count reconcile checks
+        IndexModel([("like_count_changed_at", ASCENDING)]),
+    ],
+    FollowDocument: [
+        IndexModel([("follower", ASCENDING), ("followee", ASCENDING)],
+                   unique=True),
+        # Followers and following pages, most recent first
+        IndexModel([("followee", ASCENDING), ("ulid", DESCENDING)]),
+        IndexModel([("follower", ASCENDING), ("ulid", DESCENDING)]),
+    ],
+    TimelineDocument: [
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    LikeDocument: [
+        IndexModel([("post_ulid", ASCENDING), ("username", ASCENDING)],
+                   unique=True),
+        IndexModel([("post_ulid", ASCENDING), ("ulid", DESCENDING)]),
+        IndexModel([("ulid", ASCENDING)]),
+    ],
+    CommentDocument: [
+        IndexModel([("ulid", ASCENDING)], unique=True),
+        IndexModel([("post_ulid", ASCENDING), ("parent_ulid", ASCENDING),
+                    ("ulid", ASCENDING)]),
+    ],
+    CategoryDocument: [
+        IndexModel([("name", ASCENDING)], unique=True),
+        IndexModel([("post_count", DESCENDING)]),
+    ],
+}
+
+
+class QueryShape(NamedTuple):
+    """A query the handlers run, with placeholder values, for explain()"""
+    name: str
+    document: Type[Document]
+    filter: dict[str, Any]
+    sort: Optional[list[tuple[str, int]]] = None
+
+
+_ULID = "01HAAAAAAAAAAAAAAAAAAAAAAA"
+
+QUERY_SHAPES = [
+    QueryShape("user by username", UserDocument, {"username": "user"}),
+    QueryShape("users listing", UserDocument, {}, [("username", ASCENDING)]),
+    QueryShape("revoked users", UserDocument, {"token_version": {
+        "$gt": 0
+    }}),
+    QueryShape("celebrity followees", UserDocument, {
+        "username": {
+            "$in": ["user", "other"]
+        },
+        "follower_count": {
+            "$gt": 10000
+        },
+    }),
+    QueryShape("follow edge", FollowDocument, {
+        "follower": "user",
+        "followee": "other"
+    }),
+    QueryShape("followers", FollowDocument, {
+        "followee": "user",
+        "ulid": {
+            "$lt": _ULID
+        }
+    }, [("ulid", DESCENDING)]),
+    QueryShape("following", FollowDocument, {
+        "follower": "user",
+        "ulid": {
+            "$lt": _ULID
+        }
+    }, [("ulid", DESCENDING)]),
+    QueryShape("post by ulid", PostDocument, {"ulid": _ULID}),
+    QueryShape("feed", PostDocument, {
+        "author": {
+            "$in": ["user", "other"]
+        },
+        "ulid": {
+            "$lt": _ULID
+        },
+    }, [("ulid", DESCENDING)]),
+    QueryShape("profile posts", PostDocument, {"author": "user"},
+               [("ulid", DESCENDING)]),
+    QueryShape("category", PostDocument, {"categories": "category"},
+               [("ulid", DESCENDING)]),
+    QueryShape("timeline", TimelineDocument, {"username": "user"}),
+    QueryShape("like by user", LikeDocument, {
+        "post_ulid": _ULID,
+        "username": "user"
+    }),
+    QueryShape("likers", LikeDocument, {"post_ulid": _ULID},
+               [("ulid", DESCENDING)]),
+    QueryShape("recently liked posts", PostDocument,
+               {"like_count_changed_at": {
+                   "$gte": datetime(2024, 1, 1)
+               }}),
+    QueryShape("recent likes", LikeDocument, {"ulid": {
+        "$gte": _ULID
+    }}),
+    QueryShape("comment by ulid", CommentDocument, {
+        "ulid": _ULID,
+        "post_ulid": _ULID
+    }),
+    QueryShape("comment thread", CommentDocument, {
+        "post_ulid": _ULID,
+        "parent_ulid": "",
+        "ulid": {
+            "$gt": _ULID
+        },
+    }, [("ulid", ASCENDING)]),
+    QueryShape("category by name", CategoryDocument, {"name": "category"}),
+    QueryShape("top categories", CategoryDocument, {"post_count": {
+        "$gt": 0
+    }}, [("post_count", DESCENDING)]),
+]
+
+
+# Indexes the documents used to declare through Beanie, on fields no query
+# filters on any more
+LEGACY_INDEXES: dict[Type[Document], list[str]] = {
+    UserDocument: ["id_1"],
+    PostDocument: ["title_1", "user_1"],
+}
+
+
+def _options(key, info: dict) -> tuple[list, bool]:
+    return [tuple(field) for field in key], info.get("unique", False)
+
+
+def _declared(index: IndexModel) -> tuple[list, bool]:
+    return _options(index.document["key"].items(), index.document)
+
+
+def _found(info: dict) -> tuple[list, bool]:
+    return _options(info["key"], info)
+
+
+async def ensure_indexes():
+    """Create any declared index that does not exist yet.
+
+    Legacy indexes are dropped, as are indexes with a declared name but other
+    options, like the non-unique ``posts.ulid_1`` Beanie created, which
+    ``createIndexes`` would otherwise reject with IndexOptionsConflict.
+    """
+    for document, indexes in INDEXES.items():
+        collection = document.get_motor_collection()
+        existing = await collection.index_information()
+        stale = [
+            name for name in LEGACY_INDEXES.get(document, [])
+            if name in existing
+        ]
+        stale.extend(
+            index.document["name"]
+            for index in indexes
+            if index.document["name"] in existing and
+            _found(existing[index.document["name"]]) != _declared(index))
+        for name in stale:
+            await collection.drop_index(name)
+        await collection.create_indexes(indexes)
+
+
+async def missing_indexes() -> list[str]:
+    """Return the declared indexes that are not present in the database"""
+    missing = []
+    for document, indexes in INDEXES.items():
+        collection = document.get_motor_collection()
+        existing = [
+            _found(info)
+            for info in (await collection.index_information()).values()
+        ]
+        for index in indexes:
+            if _declared(index) not in existing:
+                missing.append(f"{collection.name}.{index.document['name']}")
+    return missing
+
+
+def _stages(plan: Any):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+async def collection_scans() -> list[str]:
+    """Explain every query shape and return those that scan a collection"""
+    scans = []
+    for shape in QUERY_SHAPES:
+        cursor = shape.document.get_motor_collection().find(shape.filter)
+        if shape.sort:
+            cursor = cursor.sort(shape.sort)
+        explanation = await cursor.explain()
+        if "COLLSCAN" in _stages(explanation["queryPlanner"]["winningPlan"]):
+            scans.append(shape.name)
+    return scans
+
+
+async def main(command: str) -> int:
+    import utils
+
+    await utils.setup()
+
+    if command == "ensure":
+        await ensure_indexes()
+        return 0
+
+    if command == "verify":
+        missing = await missing_indexes()
+        for name in missing:
+            print(f"missing index: {name}")
+        return 1 if missing else 0
+
+    scans = await collection_scans()
+    for name in scans:
+        print(f"collection scan: {name}")
+    return 1 if scans else 0
+
+
+if __name__ == "__main__":
+    from utils import runtime
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["ensure", "verify", "explain"])
+    args = parser.parse_args()
+    sys.exit(runtime.run(main(args.command)))
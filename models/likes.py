@@ -0,0 +1,218 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pydantic import Field
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from ulid import ULID
+
+from models import BaseDocument
+from models.posts import PostDocument
+
+LIKES_PAGE_SIZE = 50
+MAX_LIKES_PAGE_SIZE = 200
+
+# How far back the scheduled reconcile looks. Longer than its one hour
+# period, so posts a failed run missed are picked up by the next one
+RECONCILE_WINDOW = timedelta(hours=2)
+
+
+class LikeDocument(BaseDocument):
+    """One user liking one post, kept out of the post document"""
+    ulid: str = Field(default_factory=lambda: str(ULID()))
+    post_ulid: str
+    username: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "likes"
+
+
+async def _increment_like_count(ulid: str, amount: int) -> Optional[int]:
+    post = await PostDocument.get_motor_collection().find_one_and_update(
+        {"ulid": ulid},
+        {
+            "$inc": {
+                "like_count": amount
+            },
+            # Lets the reconcile find posts whose count recently changed
+            "$set": {
+                "like_count_changed_at": datetime.utcnow()
+            },
+        },
+        projection={"like_count": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return post["like_count"] if post else None
+
+
+async def get_like_count(ulid: str) -> Optional[int]:
+    post = await PostDocument.get_motor_collection().find_one(
+        {"ulid": ulid}, projection={"like_count": 1})
+    return post.get("like_count", 0) if post else None
+
+
+async def like_post(ulid: str, username: str) -> Optional[int]:
+    """Like a post and return its like count.
+
+    The unique (post_ulid, username) index makes a repeated like a no-op, so
+    the counter on the post is incremented exactly once per user even under
+    concurrent requests. Returns None when the post does not exist.
+
+    Without that index, which `make indexes` creates, repeated likes are
+    counted again, so create it on local and offline databases too.
+    """
+    try:
+        await LikeDocument(post_ulid=ulid, username=username).insert()
+    except DuplicateKeyError:
+        return await get_like_count(ulid)
+
+    like_count = await _increment_like_count(ulid, 1)
+    if like_count is None:
+        await LikeDocument.find(LikeDocument.post_ulid == ulid,
+                                LikeDocument.username == username).delete()
+    return like_count
+
+
+async def unlike_post(ulid: str, username: str) -> Optional[int]:
+    """Unlike a post and return its like count"""
+    result = await LikeDocument.get_motor_collection().delete_one({
+        "post_ulid": ulid,
+        "username": username
+    })
+    if not result.deleted_count:
+        return await get_like_count(ulid)
+    return await _increment_like_count(ulid, -1)
+
+
+async def has_liked(ulid: str, username: str) -> bool:
+    return await LikeDocument.find_one(
+        LikeDocument.post_ulid == ulid,
+        LikeDocument.username == username) is not None
+
+
+async def get_likers(ulid: str, cursor: Optional[str],
+                     limit: int) -> tuple[list[str], Optional[str]]:
+    """Get one page of the users who liked a post, most recent first"""
+    query = LikeDocument.find(LikeDocument.post_ulid == ulid)
+    if cursor:
+        query = query.find(LikeDocument.ulid < cursor)
+    likes = await query.sort(-LikeDocument.ulid).limit(limit + 1).to_list()
+    next_cursor = likes[limit - 1].ulid if len(likes) > limit else None
+    return [like.username for like in likes[:limit]], next_cursor
+
+
+async def delete_post_likes(ulid: str):
+    await LikeDocument.find(LikeDocument.post_ulid == ulid).delete()
+
+
+async def migrate_embedded_likes() -> int:
+    """Move likes still stored on post documents into the likes collection.
+
+    Returns the number of posts migrated.
+    """
+    posts = PostDocument.get_motor_collection()
+    migrated = 0
+    legacy_posts = posts.find({"likes.0": {
+        "$exists": True
+    }},
+                              projection={
+                                  "ulid": 1,
+                                  "likes": 1
+                              })
+    async for post in legacy_posts:
+        await LikeDocument.get_motor_collection().bulk_write(
+            [
+                UpdateOne(
+                    {
+                        "post_ulid": post["ulid"],
+                        "username": username
+                    },
+                    {
+                        "$setOnInsert": {
+                            "ulid": str(ULID()),
+                            "created_at": datetime.utcnow()
+                        }
+                    },
+                    upsert=True,
+                ) for username in post["likes"]
+            ],
+            ordered=False,
+        )
+        await posts.update_one({"_id": post["_id"]}, {"$unset": {"likes": ""}})
+        migrated += 1
+    return migrated
+
+
+async def _recently_liked_posts(since: datetime) -> list[str]:
+    """Posts whose like count changed or that got a like since ``since``.
+
+    The likes are included for a like whose counter increment never ran.
+    """
+    changed = await PostDocument.get_motor_collection().distinct(
+        "ulid", {"like_count_changed_at": {
+            "$gte": since
+        }})
+    # The smallest ULID of the first millisecond of the window
+    first_ulid = str(ULID.from_datetime(since))[:10] + "0" * 16
+    liked = await LikeDocument.get_motor_collection().distinct(
+        "post_ulid", {"ulid": {
+            "$gte": first_ulid
+        }})
+    return list(set(changed) | set(liked))
+
+
+async def reconcile_like_counts(since: Optional[datetime] = None) -> int:
+    """Recount likes per post and repair drifted counters.
+
+    Only posts liked or unliked since ``since`` are checked, every post when
+    it is None. Each repair only applies if the post's like_count is still
+    the value read before counting, so a like or unlike that lands during
+    the pass is not erased. Returns the number of posts corrected.
+    """
+    post_filter, like_filter = {}, {}
+    if since is not None:
+        ulids = await _recently_liked_posts(since)
+        if not ulids:
+            return 0
+        post_filter = {"ulid": {"$in": ulids}}
+        like_filter = {"post_ulid": {"$in": ulids}}
+
+    # Read the counters before counting the likes: a change after this
+    # read moves the counter and makes the conditional repair skip the post
+    posts = PostDocument.get_motor_collection()
+    observed = {
+        post["ulid"]: post.get("like_count") async for post in posts.find(
+            post_filter, projection={
+                "_id": 0,
+                "ulid": 1,
+                "like_count": 1
+            })
+    }
+
+    grouped = LikeDocument.get_motor_collection().aggregate([{
+        "$match": like_filter
+    }, {
+        "$group": {
+            "_id": "$post_ulid",
+            "count": {
+                "$sum": 1
+            }
+        }
+    }])
+    counts = {row["_id"]: row["count"] async for row in grouped}
+
+    updates = [
+        UpdateOne({
+            "ulid": ulid,
+            "like_count": like_count
+        }, {"$set": {
+            "like_count": counts.get(ulid, 0)
+        }})
+        for ulid, like_count in observed.items()
+        if like_count != counts.get(ulid, 0)
+    ]
+    if not updates:
+        return 0
+    result = await posts.bulk_write(updates, ordered=False)
+    return result.modified_count
@@ -0,0 +1,38 @@
+"""Data migrations, run at deploy time after the indexes exist:
+
+    pipenv run python -m models.migrations
+
+Every step can be re-run. The documents are imported from their modules
+rather than run with ``python -m models.<name>``, which would load a model
+module a second time as ``__main__`` and migrate with document classes
+Beanie never initialized.
+"""
+from datetime import datetime
+
+from models.categories import recount_categories
+from models.comments import migrate_embedded_comments
+from models.follows import (migrate_embedded_follows, rebuild_following,
+                            recount_follows)
+from models.likes import migrate_embedded_likes, reconcile_like_counts
+
+
+async def main():
+    import utils
+
+    await utils.setup()
+    print(f"migrated {await migrate_embedded_follows()} users")
+    print(f"fixed the following lists of {await rebuild_following()} users")
+    print(f"fixed {await recount_follows()} follow counters")
+    started_at = datetime.utcnow()
+    print(f"migrated likes of {await migrate_embedded_likes()} posts")
+    # Only the posts whose likes were just moved need their counts checked
+    print(f"fixed the like counts of "
+          f"{await reconcile_like_counts(since=started_at)} posts")
+    print(f"migrated comments of {await migrate_embedded_comments()} posts")
+    print(f"fixed the post counts of {await recount_categories()} categories")
+
+
+if __name__ == "__main__":
+    from utils import runtime
+
+    runtime.run(main())
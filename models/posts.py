@@ -1,13 +1,18 @@
+from collections import defaultdict
 from datetime import datetime
-from typing import Optional
+from functools import lru_cache
+from typing import Optional, Type
 
 from beanie.operators import In
 from pydantic import BaseModel, validator
 from ulid import ULID
 
-from models import BaseDocument
+from models import BaseDocument, make_projection
 from models.users import UserDocument
 
+FEED_PAGE_SIZE = 20
+MAX_FEED_PAGE_SIZE = 100
+
 
 class ReplyBase(BaseModel):
     ulid: str
@@ -36,14 +41,17 @@ class Reply(ReplyBase):
     replies: list["Reply"] = []
 
 
-class Post(BaseModel):
+REPLY_FIELDS = tuple(ReplyBase.__fields__)
+
+
+class PostBase(BaseModel):
+    """A post without its replies, used for feed listings"""
     ulid: str
     title: str
     author: str
     content: str
     categories: list[str] = []
-    likes: list[str] = []
-    replies: list[Reply] = []
+    like_count: int = 0
     created_at: datetime = datetime.now()
     updated_at: datetime = datetime.now()
 
@@ -58,32 +66,179 @@ class Post(BaseModel):
         raise ValueError("ULID must be a string or a ULID object")
 
 
+class Post(PostBase):
+    replies: list[Reply] = []
+
+
+class PostCreate(BaseModel):
+    """The fields an author sets when writing a post"""
+    title: str
+    content: str
+    categories: list[str] = []
+
+
+class PostUpdate(BaseModel):
+    """The fields an author can change on a post"""
+    title: Optional[str]
+    content: Optional[str]
+    categories: Optional[list[str]]
+
+
+class PostDetail(PostBase):
+    """A post as stored, with its flat list of embedded replies"""
+    replies: list[ReplyDocument] = []
+
+
+# Fields clients can select with ?fields= on post listings
+POST_FIELDS = frozenset(PostBase.__fields__)
+
+
+@lru_cache(maxsize=None)
+def post_projection(fields: frozenset[str]) -> Type[PostBase]:
+    """A projection of the requested post fields, always including the ulid"""
+    return make_projection(PostDetail, fields | {"ulid"})
+
+
 class PostDocument(BaseDocument, Post):
     replies: list[ReplyDocument] = []
 
     class Settings:
         name = "posts"
-        indexes = [("title",), ("user",), ("ulid",)]
 
 
-async def get_recent_posts(user: UserDocument) -> list[PostDocument]:
-    all_posts = []
-    user_posts = await PostDocument.find(PostDocument.author == user.username
-                                        ).to_list()
-    all_posts.extend(user_posts)
-    following_posts = await PostDocument.find(
-        In(PostDocument.author, user.following)).to_list()
-    all_posts.extend(following_posts)
-    return all_posts
+async def get_recent_posts(
+        user: UserDocument,
+        cursor: Optional[str] = None,
+        limit: int = FEED_PAGE_SIZE,
+        projection: Type[PostBase] = PostBase
+) -> tuple[list[PostBase], Optional[str]]:
+    """Get one page of the user's feed, newest first.
+
+    ULIDs sort by creation time, so the feed is ordered by ULID and the
+    cursor is the ULID of the last post on the previous page.
+    """
+    query = PostDocument.find(
+        In(PostDocument.author, [user.username, *user.following]))
+    if cursor:
+        query = query.find(PostDocument.ulid < cursor)
+
+    # Fetch one extra post to know whether there is a next page
+    posts = await query.sort(-PostDocument.ulid).limit(limit + 1).project(
+        projection).to_list()
+    next_cursor = posts[limit - 1].ulid if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+
+async def find_embedded_reply(post_ulid: str,
+                              reply_ulid: str) -> tuple[bool, Optional[dict]]:
+    """Look up one reply embedded in a post without loading the others.
+
+    Returns whether the post exists and the raw reply, if any.
+    """
+    post = await PostDocument.get_motor_collection().find_one(
+        {"ulid": post_ulid},
+        projection={"replies": {
+            "$elemMatch": {
+                "ulid": reply_ulid
+            }
+        }})
+    if post is None:
+        return False, None
+    replies = post.get("replies") or []
+    return True, replies[0] if replies else None
+
+
+async def set_embedded_reply_like(post_ulid: str, reply_ulid: str,
+                                  username: str, liked: bool) -> bool:
+    """Add or remove a like on one embedded reply in place.
+
+    Only the matching array element is updated on the server, so concurrent
+    likes on replies of the same post cannot overwrite each other. Returns
+    False when the post or reply does not exist.
+    """
+    operator = "$addToSet" if liked else "$pull"
+    result = await PostDocument.get_motor_collection().update_one(
+        {
+            "ulid": post_ulid,
+            "replies.ulid": reply_ulid
+        },
+        {operator: {
+            "replies.$[reply].likes": username
+        }},
+        array_filters=[{
+            "reply.ulid": reply_ulid
+        }],
+    )
+    return bool(result.matched_count)
+
+
+async def delete_embedded_reply(post_ulid: str, reply_ulid: str,
+                                author: str) -> bool:
+    """Remove one embedded reply if it was written by ``author``"""
+    result = await PostDocument.get_motor_collection().update_one(
+        {
+            "ulid": post_ulid,
+            "replies": {
+                "$elemMatch": {
+                    "ulid": reply_ulid,
+                    "author": author
+                }
+            }
+        },
+        {"$pull": {
+            "replies": {
+                "ulid": reply_ulid
+            }
+        }},
+    )
+    return bool(result.modified_count)
+
+
+async def get_category_posts(
+        category: str,
+        cursor: Optional[str],
+        limit: int,
+        projection: Type[PostBase] = PostBase
+) -> tuple[list[PostBase], Optional[str]]:
+    """Get one page of a category's posts, newest first, without replies"""
+    query = PostDocument.find(PostDocument.categories == category)
+    if cursor:
+        query = query.find(PostDocument.ulid < cursor)
+    posts = await query.sort(-PostDocument.ulid).limit(limit + 1).project(
+        projection).to_list()
+    next_cursor = posts[limit - 1].ulid if len(posts) > limit else None
+    return posts[:limit], next_cursor
 
 
 def make_replies_tree(replies: list[ReplyDocument],
-                      parent_ulid: str = "") -> list[Reply]:
-    tree = []
+                      parent_ulid: str = "",
+                      max_depth: Optional[int] = None,
+                      max_children: Optional[int] = None) -> list[Reply]:
+    """Nest a flat list of replies under their parents.
+
+    Replies are grouped by ``parent_ulid`` in one pass and the tree is built
+    iteratively, so long threads and deep chains cost O(n). ``max_depth``
+    limits how many levels are returned and ``max_children`` how many replies
+    are kept under each parent. The replies were validated when they were
+    loaded, so the tree nodes are constructed without validating them again.
+
+    No handler calls this: comments live in their own collection and
+    /comments pages them one parent at a time. It is only used by
+    ``benchmarks.bench_replies_tree``.
+    """
+    children = defaultdict(list)
     for reply in replies:
-        if reply.parent_ulid == parent_ulid:
-            tree.append(
-                Reply(**reply.dict(),
-                      replies=make_replies_tree(replies, reply.ulid)))
-    print(tree)
+        children[reply.parent_ulid or ""].append(reply)
+
+    tree = []
+    pending = [(parent_ulid, tree, 1)]
+    while pending:
+        parent, siblings, depth = pending.pop()
+        for reply in children.get(parent, [])[:max_children]:
+            node = Reply.construct(
+                **{field: getattr(reply, field) for field in REPLY_FIELDS},
+                replies=[])
+            siblings.append(node)
+            if max_depth is None or depth < max_depth:
+                pending.append((reply.ulid, node.replies, depth + 1))
     return tree
@@ -0,0 +1,61 @@
+"""JSON encoding for handler responses.
+
+Models are encoded straight from their field values, without the
+``dict()`` copy and re-validation that ``Model(**doc.dict()).json()`` costs.
+orjson is used when it is installed, otherwise the standard library.
+"""
+import json
+from datetime import datetime
+from typing import AbstractSet, Any
+
+from beanie import Document
+from bson import ObjectId
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Storage fields Beanie adds to every document, never part of a response
+DOCUMENT_FIELDS = frozenset({"id", "revision_id"})
+
+
+def fields_of(model: BaseModel,
+              exclude: AbstractSet[str] = frozenset()) -> dict[str, Any]:
+    """Shallow copy of a model's field values, nested models are left as is"""
+    if isinstance(model, Document):
+        exclude = DOCUMENT_FIELDS | exclude
+    if not exclude:
+        return dict(model.__dict__)
+    return {
+        name: value
+        for name, value in model.__dict__.items()
+        if name not in exclude
+    }
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Document):
+        return fields_of(obj)
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def dumpb(obj: Any) -> bytes:
+    """Encode ``obj`` to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+def dumps(obj: Any) -> str:
+    """Encode ``obj`` to a JSON string, for Lambda proxy response bodies"""
+    return dumpb(obj).decode()
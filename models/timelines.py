@@ -0,0 +1,192 @@
+from typing import Optional, Type
+
+from beanie.operators import In
+from pymongo import DESCENDING, ReturnDocument, UpdateOne
+
+from models import BaseDocument
+from models.posts import (PostBase, PostDocument, get_recent_posts,
+                          post_projection)
+from models.users import UserDocument
+
+
+class TimelineDocument(BaseDocument):
+    """Precomputed home feed of a user, as post ULIDs newest first"""
+    username: str
+    entries: list[str] = []
+
+    class Settings:
+        name = "timelines"
+
+
+async def fan_out_post(post: PostDocument, usernames: list[str],
+                       max_length: int):
+    """Push a new post onto the timelines of the given users.
+
+    Entries are kept sorted by ULID and trimmed to ``max_length`` in the same
+    update, so concurrent posts cannot leave a timeline out of order. Users
+    without a timeline are skipped, it is seeded with their whole feed when
+    they first read it.
+    """
+    if not usernames:
+        return
+    await TimelineDocument.get_motor_collection().bulk_write(
+        [
+            UpdateOne(
+                {"username": username},
+                {
+                    "$push": {
+                        "entries": {
+                            "$each": [post.ulid],
+                            "$sort": -1,
+                            "$slice": max_length,
+                        }
+                    }
+                },
+            ) for username in usernames
+        ],
+        ordered=False,
+    )
+
+
+async def seed_timeline(user: UserDocument, max_length: int) -> list[str]:
+    """Create the user's timeline from their read-time feed.
+
+    Returns the entries of the timeline, which a concurrent seed may have
+    created first.
+    """
+    posts, _ = await get_recent_posts(user, None, max_length,
+                                      post_projection(frozenset()))
+    collection = TimelineDocument.get_motor_collection()
+    timeline = await collection.find_one_and_update(
+        {"username": user.username},
+        {"$setOnInsert": {
+            "entries": [post.ulid for post in posts]
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return timeline["entries"]
+
+
+async def add_to_timeline(username: str, followee: str, max_length: int):
+    """Merge the recent posts of a newly followed user into a timeline"""
+    posts = await PostDocument.get_motor_collection().find(
+        {
+            "author": followee
+        },
+        projection={
+            "ulid": 1
+        },
+    ).sort("ulid", DESCENDING).limit(max_length).to_list(length=None)
+    if not posts:
+        return
+    await TimelineDocument.get_motor_collection().update_one(
+        {"username": username},
+        {
+            "$push": {
+                "entries": {
+                    "$each": [post["ulid"] for post in posts],
+                    "$sort": -1,
+                    "$slice": max_length,
+                }
+            }
+        },
+    )
+
+
+async def remove_from_timeline(username: str, followee: str):
+    """Drop the posts of an unfollowed user from a timeline"""
+    timeline = await TimelineDocument.find_one(
+        TimelineDocument.username == username)
+    if not timeline or not timeline.entries:
+        return
+    posts = await PostDocument.get_motor_collection().find(
+        {
+            "ulid": {
+                "$in": timeline.entries
+            },
+            "author": followee
+        },
+        projection={
+            "ulid": 1
+        },
+    ).to_list(length=None)
+    if posts:
+        await TimelineDocument.get_motor_collection().update_one(
+            {"username": username},
+            {"$pull": {
+                "entries": {
+                    "$in": [post["ulid"] for post in posts]
+                }
+            }},
+        )
+
+
+async def get_celebrities(usernames: list[str], threshold: int) -> list[str]:
+    """Return which of the given users have more than ``threshold`` followers"""
+    if not usernames:
+        return []
+    celebrities = await UserDocument.get_motor_collection().find(
+        {
+            "username": {
+                "$in": usernames
+            },
+            "follower_count": {
+                "$gt": threshold
+            }
+        },
+        projection={
+            "username": 1
+        },
+    ).to_list(length=None)
+    return [celebrity["username"] for celebrity in celebrities]
+
+
+async def get_timeline_posts(
+        user: UserDocument,
+        cursor: Optional[str],
+        limit: int,
+        threshold: int,
+        max_length: int,
+        projection: Type[PostBase] = PostBase
+) -> tuple[list[PostBase], Optional[str]]:
+    """Get one page of the user's feed from their precomputed timeline.
+
+    Posts by followed accounts over the follower threshold are not fanned
+    out, so they are read from the posts collection and merged in. Users
+    without a timeline yet get one seeded from the read-time feed.
+    """
+    timeline = await TimelineDocument.find_one(
+        TimelineDocument.username == user.username)
+    entries = (timeline.entries if timeline else await seed_timeline(
+        user, max_length))
+
+    ulids = [ulid for ulid in entries if not cursor or ulid < cursor]
+    posts = []
+    if ulids:
+        # Entries of an unfollow that raced with a fan-out are left behind,
+        # only the authors still followed are shown
+        posts = await PostDocument.find(
+            In(PostDocument.ulid, ulids[:limit + 1]),
+            In(PostDocument.author, [user.username, *user.following]),
+        ).project(projection).to_list()
+
+    celebrities = await get_celebrities(user.following, threshold)
+    if celebrities:
+        query = PostDocument.find(In(PostDocument.author, celebrities))
+        if cursor:
+            query = query.find(PostDocument.ulid < cursor)
+        posts.extend(await query.sort(-PostDocument.ulid).limit(
+            limit + 1).project(projection).to_list())
+
+    # Posts fanned out before their author went over the threshold are in
+    # the timeline and in the celebrity query, keep one copy of each
+    posts = list({post.ulid: post for post in posts}.values())
+    # Deleted posts are not removed from timelines, they just drop out here
+    posts.sort(key=lambda post: post.ulid, reverse=True)
+    has_more = len(posts) > limit or len(ulids) > limit
+    posts = posts[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = posts[-1].ulid if posts else ulids[limit - 1]
+    return posts, next_cursor
@@ -1,13 +1,19 @@
+import asyncio
 import re
-from typing import Any, Optional
+from functools import lru_cache
+from typing import Iterable, Optional, Type
 
 import pydantic
-from beanie import Indexed
 from beanie.odm.fields import PydanticObjectId
 from beanie.operators import In
 from pydantic.types import SecretStr
+from pymongo import ReturnDocument
 
-from models import BaseDocument
+from models import BaseDocument, make_projection
+from utils import runtime
+
+# Never included in responses
+PRIVATE_FIELDS = frozenset({"password", "scopes", "token_version"})
 
 
 class UserOut(pydantic.BaseModel):
@@ -47,8 +53,6 @@ class UserUpdate(pydantic.BaseModel):
 class User(UserOut):
     password: SecretStr
     scopes: list[str] = []
-    followers: Optional[list["UserOut"]] = None
-    following: Optional[list["UserOut"]] = None
 
     class Config:
         json_encoders = {
@@ -57,51 +61,100 @@ class User(UserOut):
         extra = "ignore"  # Ignore fields not defined in the model
 
     def json(self, *args, **kwargs):
-        return super().json(*args, **kwargs, exclude={"password", "scopes"})
+        return super().json(*args, **kwargs, exclude=PRIVATE_FIELDS)
 
 
 class UserDocument(User, BaseDocument):
-    username: Indexed(str, unique=True)
+    """A user account.
+
+    Follow relationships live in the follows collection. ``following`` is
+    also kept here because the read-time feed queries by it, and the counts
+    are maintained alongside the edges.
+    """
+    username: str
     password: str
-    followers: list[str] = []
     following: list[str] = []
+    follower_count: int = 0
+    following_count: int = 0
+    # Tokens carry the version they were issued at, bumping it revokes them
+    token_version: int = 0
 
     class Settings:
         name = "users"
-        indexes = [("id",), ("username",)]
-
-
-async def get_followers(follower_ids: list[str]):
-    if not follower_ids:
-        return []
-    followers = await UserDocument.find(In(UserDocument.username, follower_ids),
-                                        limit=100).to_list()
-    return followers
 
 
-async def get_following(following_ids: list[str]):
-    if not following_ids:
-        return []
-    following = await UserDocument.find(In(UserDocument.username,
-                                           following_ids),
-                                        limit=100).to_list()
-    return following
-
-
-async def generate_user_dict(user: UserDocument) -> dict[str, Any]:
-    return {
-        **user.dict(),
-        "followers": [
-            UserOut(**user.dict()).dict()
-            for user in await get_followers(user.followers)
-        ],
-        "following": [
-            UserOut(**user.dict()).dict()
-            for user in await get_following(user.following)
-        ],
-    }
+class UserSummary(UserOut):
+    """Projection of a user with its relationship counts"""
+    follower_count: int = 0
+    following_count: int = 0
+
+
+@lru_cache(maxsize=None)
+def profile_projection(fields: frozenset[str]) -> Type[pydantic.BaseModel]:
+    """A projection of the requested profile fields, always including the
+    username"""
+    return make_projection(UserSummary, fields | {"username"})
+
+
+class UserLoader:
+    """Batches the ``UserOut`` lookups made while serving one request.
+
+    Every username requested with :meth:`load` during the same event loop
+    iteration is fetched with a single projected query, and each username is
+    fetched at most once. Create one loader per request and share it between
+    the coroutines building the response.
+    """
+
+    def __init__(self):
+        self._futures: dict[str, asyncio.Future] = {}
+        self._queue: list[str] = []
+
+    def load(self, username: str) -> "asyncio.Future[Optional[UserOut]]":
+        future = self._futures.get(username)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[username] = loop.create_future()
+            if not self._queue:
+                # Let the other coroutines queue their usernames first
+                loop.call_soon(lambda: runtime.spawn(self._dispatch()))
+            self._queue.append(username)
+        return future
+
+    async def load_many(self, usernames: Iterable[str]) -> list[UserOut]:
+        """Load users in order, skipping the ones that do not exist"""
+        users = await asyncio.gather(*[self.load(name) for name in usernames])
+        return [user for user in users if user is not None]
+
+    async def _dispatch(self):
+        usernames, self._queue = self._queue, []
+        try:
+            users = await UserDocument.find(In(
+                UserDocument.username, usernames)).project(UserOut).to_list()
+        except Exception as e:
+            for username in usernames:
+                self._futures.pop(username).set_exception(e)
+            return
+        found = {user.username: user for user in users}
+        for username in usernames:
+            self._futures[username].set_result(found.get(username))
 
 
 async def find_user(username: str) -> UserDocument:
     found_user = await UserDocument.find_one({"username": username})
     return found_user
+
+
+async def revoke_tokens(username: str) -> Optional[int]:
+    """Invalidate every token issued to a user so far.
+
+    Returns the user's new token version, or None if the user does not exist.
+    """
+    user = await UserDocument.get_motor_collection().find_one_and_update(
+        {"username": username},
+        {"$inc": {
+            "token_version": 1
+        }},
+        projection={"token_version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return user["token_version"] if user else None
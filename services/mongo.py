@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Optional, Type
+
+from beanie import Document, init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+from utils.logging import LOG_MANAGER
+
+logger = LOG_MANAGER.getLogger(__name__)
+
+
+class MongoConnectionManager:
+    """Keeps one Motor client and one Beanie registry per container.
+
+    Lambda reuses the Python process between warm invocations, so the client
+    and the Beanie initialization are kept at module level instead of being
+    rebuilt by every handler. Motor clients are bound to the event loop they
+    were first used on, so if the running loop changes the client is rebuilt
+    and the already initialized document classes are pointed at the new
+    database without re-running ``init_beanie`` (and its index round trips).
+    """
+
+    def __init__(self, database_name: str, max_pool_size: int = 10):
+        self.database_name = database_name
+        self.max_pool_size = max_pool_size
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.database: Optional[AsyncIOMotorDatabase] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._initialized_models: set[Type[Document]] = set()
+        self._lock = asyncio.Lock()
+
+    async def setup(self, uri: str,
+                    document_models: list[Type[Document]]) -> AsyncIOMotorDatabase:
+        """Return the shared database, connecting and initializing if needed"""
+        loop = asyncio.get_running_loop()
+        if (self._loop is loop and
+                self._initialized_models.issuperset(document_models)):
+            return self.database
+
+        if self._loop is not loop:
+            # asyncio.Lock binds to the loop it is first awaited on
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._loop is not loop:
+                self._connect(uri, loop)
+
+            pending = [
+                model for model in document_models
+                if model not in self._initialized_models
+            ]
+            if pending:
+                start = time.perf_counter()
+                logger.info("Initializing Beanie")
+                await init_beanie(self.database, document_models=pending)
+                self._initialized_models.update(pending)
+                logger.info(
+                    "Beanie initialized",
+                    extra={"duration_ms": (time.perf_counter() - start) * 1000},
+                )
+
+        return self.database
+
+    def _connect(self, uri: str, loop: asyncio.AbstractEventLoop):
+        if self.client is not None:
+            logger.info("Event loop changed, rebuilding Mongo client")
+            self.client.close()
+
+        self.client = AsyncIOMotorClient(uri,
+                                         maxPoolSize=self.max_pool_size,
+                                         io_loop=loop)
+        self.database = self.client[self.database_name]
+        self._loop = loop
+
+        for model in self._initialized_models:
+            self._rebind(model)
+
+    def _rebind(self, model: Type[Document]):
+        """Point an initialized document class at the current database"""
+        settings = model.get_settings()
+        settings.motor_db = self.database
+        settings.motor_collection = self.database[settings.name]
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.database = None
+        self._loop = None
+        self._initialized_models.clear()
+
+
+CONNECTION_MANAGER = MongoConnectionManager("social_media")
@@ -1,32 +1,148 @@
-# Use this code snippet in your app.
-# If you need more information about configurations
-# or implementing the sample code, visit the AWS docs:
-# https://aws.amazon.com/developer/language/python/
+import os
+import threading
+import time
+from typing import Optional
 
-import boto3
-from botocore.exceptions import ClientError
+from utils.logging import LOG_MANAGER
 
+logger = LOG_MANAGER.getLogger(__name__)
 
-def get_secret():
+SECRET_NAME = "authSecrets"
+REGION_NAME = "us-east-1"
 
-    secret_name = "authSecrets"
-    region_name = "us-east-1"
+CURRENT = "AWSCURRENT"
+PREVIOUS = "AWSPREVIOUS"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name='secretsmanager',
-                            region_name=region_name)
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name)
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
+class SecretsManagerProvider:
+    """Reads a secret's versions from AWS Secrets Manager"""
 
-    # Decrypts secret using the associated KMS key.
-    secret = get_secret_value_response['SecretString']
+    def __init__(self, secret_name: str, region_name: str):
+        self.secret_name = secret_name
+        self.region_name = region_name
+        self._client = None
 
-    # Your code goes here.
-    return secret
+    @property
+    def client(self):
+        # Created once per container instead of once per call
+        if self._client is None:
+            # boto3 is slow to import, only pay for it when the secret is used
+            import boto3
+            session = boto3.session.Session()
+            self._client = session.client(service_name="secretsmanager",
+                                          region_name=self.region_name)
+        return self._client
+
+    def fetch(self, version_stage: str = CURRENT) -> Optional[str]:
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.get_secret_value(SecretId=self.secret_name,
+                                                    VersionStage=version_stage)
+        except ClientError as e:
+            # A secret that has never been rotated has no AWSPREVIOUS version
+            if (version_stage != CURRENT and e.response["Error"]["Code"]
+                    == "ResourceNotFoundException"):
+                return None
+            raise e
+        return response["SecretString"]
+
+
+class LocalSecretProvider:
+    """Reads the secret from the environment or a file, for tests and local runs.
+
+    ``AUTH_SECRET`` (or the contents of ``AUTH_SECRET_FILE``) is the current
+    key and ``AUTH_SECRET_PREVIOUS`` the optional previous one.
+    """
+
+    def fetch(self, version_stage: str = CURRENT) -> Optional[str]:
+        if version_stage == PREVIOUS:
+            return os.environ.get("AUTH_SECRET_PREVIOUS")
+        if "AUTH_SECRET_FILE" in os.environ:
+            with open(os.environ["AUTH_SECRET_FILE"]) as f:
+                return f.read().strip()
+        return os.environ["AUTH_SECRET"]
+
+
+class CachedSecret:
+    """In-process cache of the current and previous versions of a secret.
+
+    Values are served from memory for ``ttl`` seconds. Once a value is within
+    ``refresh_ahead`` seconds of expiring a background thread fetches the new
+    versions, so requests only block on Secrets Manager when the cache is
+    empty or fully expired.
+    """
+
+    def __init__(self, provider, ttl: float = 300, refresh_ahead: float = 60):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self._current: Optional[str] = None
+        self._previous: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        current = self.provider.fetch(CURRENT)
+        previous = self.provider.fetch(PREVIOUS)
+        with self._lock:
+            self._current = current
+            self._previous = previous if previous != current else None
+            self._expires_at = time.monotonic() + self.ttl
+
+    def _background_refresh(self):
+        try:
+            self._load()
+        except Exception as e:
+            logger.error(f"Background secret refresh failed: {e}", extra={})
+        finally:
+            self._refreshing = False
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._current is None or now >= self._expires_at:
+            self._load()
+            return
+
+        if now >= self._expires_at - self.refresh_ahead:
+            with self._lock:
+                if self._refreshing:
+                    return
+                self._refreshing = True
+            threading.Thread(target=self._background_refresh,
+                             daemon=True).start()
+
+    def current(self) -> str:
+        """The key new tokens should be signed with"""
+        self._ensure_fresh()
+        return self._current
+
+    def keys(self) -> list[str]:
+        """Keys tokens may be verified with, current first"""
+        self._ensure_fresh()
+        return [key for key in (self._current, self._previous) if key]
+
+    def invalidate(self):
+        with self._lock:
+            self._expires_at = 0.0
+
+
+def _default_provider():
+    if "AUTH_SECRET" in os.environ or "AUTH_SECRET_FILE" in os.environ:
+        return LocalSecretProvider()
+    return SecretsManagerProvider(SECRET_NAME, REGION_NAME)
+
+
+AUTH_SECRET = CachedSecret(_default_provider(),
+                           ttl=float(os.environ.get("SECRET_TTL_SECONDS", 300)))
+
+
+def get_secret() -> str:
+    """Return the current signing secret from the in-process cache"""
+    return AUTH_SECRET.current()
+
+
+def get_secret_keys() -> list[str]:
+    """Return the current and, during a rotation, the previous secret"""
+    return AUTH_SECRET.keys()
@@ -1,49 +1,141 @@
+import os
 from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Iterable, Optional
 
 import jwt
-from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
-from neomodel import config
-
-from config import CONFIG
-from models.posts import PostDocument
-from models.users import UserDocument
-from services.secrets import get_secret
+from ulid import ULID
+
+import config
+# Service modules log through utils.logging, which runs this package first.
+# Importing the modules rather than names from them keeps that cycle working
+# whichever side is imported first
+from services import mongo, secrets
 from utils.logging import LOG_MANAGER
 
-config.DATABASE_URL = (
-    f"bolt://{CONFIG.neo4j_username}:{CONFIG.neo4j_password}@{CONFIG.neo4j_uri}"
-)
+if TYPE_CHECKING:
+    from models.users import UserDocument
 
 logger = LOG_MANAGER.getLogger(__name__)
 
 
 async def setup():
-    """Initialize connections to databases"""
-    db = AsyncIOMotorClient(CONFIG.mongo_uri).social_media
-    logger.info("Initializing Beanie")
-    await init_beanie(db, document_models=[UserDocument, PostDocument])
+    """Initialize connections to databases, reusing them on warm starts"""
+    # Models are imported here rather than at the top because some of them
+    # use utils submodules, and importing those runs this package first
+    from models.categories import CategoryDocument
+    from models.comments import CommentDocument
+    from models.follows import FollowDocument
+    from models.likes import LikeDocument
+    from models.posts import PostDocument
+    from models.timelines import TimelineDocument
+    from models.users import UserDocument
 
+    await mongo.CONNECTION_MANAGER.setup(
+        config.get_config().mongo_uri,
+        document_models=[
+            UserDocument, PostDocument, TimelineDocument, LikeDocument,
+            CommentDocument, CategoryDocument, FollowDocument
+        ])
 
-def get_current_user(event: dict, context) -> str:
-    """Get the current user from the JWT token"""
 
+def is_local() -> bool:
+    """Whether we run outside Lambda, under serverless-offline or in tests"""
+    return ("IS_OFFLINE" in os.environ or
+            "AWS_LAMBDA_FUNCTION_NAME" not in os.environ)
+
+
+def get_auth_context(event: dict) -> dict[str, str]:
+    """Get the caller's username, scopes and user id.
+
+    Behind API Gateway these come from the context the authorizer returned,
+    so the token is not decoded again. Only local runs, where no authorizer
+    ran, fall back to decoding the token. Raises KeyError when neither is
+    available.
+    """
+    authorizer = (event.get("requestContext") or {}).get("authorizer") or {}
+    # HTTP APIs nest a Lambda authorizer's context under "lambda"
+    auth_context = authorizer.get("lambda", authorizer)
+    if "username" in auth_context:
+        return auth_context
+    if not is_local():
+        raise KeyError("authorizer context")
+
+    payload = decode_token(event["headers"]["authorization-token"])
+    return {
+        "username": payload["username"],
+        "scopes": " ".join(payload.get("scope", [])),
+        "user_id": payload.get("uid", ""),
+    }
+
+
+def get_current_user(event: dict, context) -> str:
+    """Get the username of the caller"""
+    username = get_auth_context(event)["username"]
     logger.info(
-        f"Grabbing user from token: {event['headers']['authorization-token']}",
+        f"Request from {username}",
         extra={"handler": context.function_name},
     )
-    header = event["headers"]["authorization-token"]
-    payload = jwt.decode(header, get_secret(), algorithms=["HS256"])
-    return payload["username"]
+    return username
 
 
-def generate_token(user: UserDocument) -> str:
+def decode_token(token: str) -> dict:
+    """Decode a JWT, accepting the previous secret while it is being rotated"""
+    keys = secrets.get_secret_keys()
+    for key in keys[:-1]:
+        try:
+            return jwt.decode(token, key, algorithms=["HS256"])
+        except jwt.exceptions.InvalidSignatureError:
+            continue
+    return jwt.decode(token, keys[-1], algorithms=["HS256"])
+
+
+def generate_token(user: "UserDocument",
+                   scopes: Optional[Iterable[str]] = None) -> str:
+    """Issue a token for ``user``, limited to ``scopes`` when given"""
     payload = {
         "username": user.username,
-        "scope": user.scopes,
+        "scope": user.scopes if scopes is None else list(scopes),
+        "ver": user.token_version,
+        "uid": str(user.id),
         "exp": datetime.now(tz=timezone.utc) + timedelta(days=1)
     }
 
-    token = jwt.encode(payload=payload, key=get_secret())
+    token = jwt.encode(payload=payload, key=secrets.get_secret())
 
     return token
+
+
+def get_fields(event: dict, allowed: frozenset[str]) -> Optional[frozenset[str]]:
+    """Read the comma separated ``fields`` query parameter of a request.
+
+    Returns None when the client did not ask for specific fields. Raises
+    ValueError for fields that are not in ``allowed``.
+    """
+    params = event.get("queryStringParameters") or {}
+    if not params.get("fields"):
+        return None
+
+    fields = frozenset(
+        field.strip() for field in params["fields"].split(",") if field.strip())
+    unknown = fields - allowed
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def get_page_params(event: dict, default_limit: int,
+                    max_limit: int) -> tuple[Optional[str], int]:
+    """Read the ``cursor`` and ``limit`` query parameters of a paginated request.
+
+    Raises ValueError when the cursor is not a ULID or the limit is not a
+    positive integer.
+    """
+    params = event.get("queryStringParameters") or {}
+    cursor = params.get("cursor") or None
+    if cursor:
+        ULID.from_str(cursor)
+
+    limit = int(params.get("limit", default_limit))
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return cursor, min(limit, max_limit)
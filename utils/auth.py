@@ -0,0 +1,157 @@
+"""Authorization decisions cached per container.
+
+The authorizer looks a token up here before decoding it or touching Mongo.
+Decisions are cached under the token's SHA-256 for at most
+``AUTH_CACHE_TTL`` seconds and never past the token's ``exp``.
+
+A revoked token keeps working until every cache in front of the user lookup
+has expired: API Gateway's policy cache (``resultTtlInSeconds``), then this
+decision cache, then in the stateless mode the revocation list, refreshed
+every ``REVOCATION_REFRESH_SECONDS``. With the defaults that is up to 180
+seconds.
+
+Tokens carry OAuth style scopes. ``read`` allows the GET routes, ``write``
+the routes that change data and ``admin`` the user listing. Users and tokens
+that name neither ``read`` nor ``write`` also get :data:`DEFAULT_SCOPES`, so
+``admin`` alone adds the listing to a default user's routes.
+
+In the stateless auth mode a cache miss is decided from the token alone plus
+:data:`REVOCATIONS`, a periodically refreshed map of the users who revoked
+their tokens, instead of a user lookup per token.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from typing import Iterable, NamedTuple, Optional
+
+from models.users import UserDocument, revoke_tokens
+from utils import runtime
+from utils.cache import TTLCache
+from utils.logging import LOG_MANAGER
+
+logger = LOG_MANAGER.getLogger(__name__)
+
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+
+READ = "read"
+WRITE = "write"
+ADMIN = "admin"
+DEFAULT_SCOPES = (READ, WRITE)
+
+
+def effective_scopes(scopes: Iterable[str]) -> tuple[str, ...]:
+    """The scopes plus the defaults, unless they name ``read`` or ``write``"""
+    scopes = tuple(scopes)
+    if READ in scopes or WRITE in scopes:
+        return scopes
+    return DEFAULT_SCOPES + scopes
+
+
+def grant_scopes(granted: Iterable[str],
+                 requested: Iterable[str]) -> tuple[str, ...]:
+    """The scopes of ``requested`` that ``granted`` includes, in order"""
+    granted = effective_scopes(granted)
+    return tuple(scope for scope in effective_scopes(requested)
+                 if scope in granted)
+
+
+class Decision(NamedTuple):
+    username: str
+    allowed: bool
+    scopes: tuple[str, ...] = ()
+    user_id: str = ""
+
+    def context(self) -> dict[str, str]:
+        """Authorizer context handed to the handlers with the request.
+
+        API Gateway only passes flat string, number and boolean values, so
+        scopes are joined with spaces.
+        """
+        return {
+            "username": self.username,
+            "scopes": " ".join(self.scopes),
+            "user_id": self.user_id,
+        }
+
+
+DECISIONS = TTLCache(ttl=AUTH_CACHE_TTL, maxsize=4096)
+
+
+def token_key(token: str) -> str:
+    # Tokens are credentials, keep only their hash in memory
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_decision(token: str) -> Optional[Decision]:
+    return DECISIONS.get(token_key(token))
+
+
+def cache_decision(token: str, decision: Decision, expires_at: float):
+    """Cache a decision until the token expires or the cache TTL runs out"""
+    ttl = expires_at - time.time()
+    if ttl > 0:
+        DECISIONS.set(token_key(token), decision, ttl)
+
+
+class RevocationList:
+    """Token versions of every user who has revoked tokens.
+
+    Only users with a non-zero ``token_version`` are loaded, a single
+    projected query. The map is reloaded every ``ttl`` seconds: the first
+    load blocks, later ones run in the background while the previous map
+    keeps answering.
+    """
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._versions: Optional[dict[str, int]] = None
+        self._expires_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def _load(self):
+        users = UserDocument.get_motor_collection().find(
+            {"token_version": {
+                "$gt": 0
+            }},
+            projection={
+                "_id": 0,
+                "username": 1,
+                "token_version": 1
+            })
+        self._versions = {
+            user["username"]: user["token_version"] async for user in users
+        }
+        self._expires_at = time.monotonic() + self.ttl
+
+    async def _background_load(self):
+        try:
+            await self._load()
+        except Exception as e:
+            logger.error(f"Revocation list refresh failed: {e}", extra={})
+
+    async def get_version(self, username: str) -> int:
+        """The token version a user's tokens must carry to be valid"""
+        if self._versions is None:
+            await self._load()
+        elif time.monotonic() >= self._expires_at and (
+                self._refresh is None or self._refresh.done()):
+            self._refresh = runtime.spawn(self._background_load())
+        return self._versions.get(username, 0)
+
+
+REVOCATIONS = RevocationList(
+    ttl=float(os.environ.get("REVOCATION_REFRESH_SECONDS", 60)))
+
+
+async def revoke_user(username: str):
+    """Revoke a user's tokens, on password change or account deletion.
+
+    Bumps the user's token version. This runs in the handler's Lambda, not
+    the authorizer's, so nothing cached by the authorizer is cleared: the
+    old tokens stop working within the window in the module docstring.
+    Deleting a user document outright would drop it from the revocation
+    list, so stateless mode relies on deleted accounts being revoked and
+    kept.
+    """
+    await revoke_tokens(username)
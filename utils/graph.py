@@ -2,14 +2,31 @@
 ### Since Neo4j does not have a free tier, we had to use a different database for our project.
 ### The code below is left as an example of how we would have implemented the graph database.
 
+### Nothing imports this module unless the graph features are enabled, so neo4j and
+### neomodel are never loaded on the hot path.
+
+from functools import lru_cache
+
 from neo4j import GraphDatabase, basic_auth
 from neomodel import RelationshipTo, StringProperty, StructuredNode
+from neomodel import config as neomodel_config
+
+from config import get_config
+
 
-from config import CONFIG
+@lru_cache(maxsize=None)
+def get_driver():
+    """Open the Neo4j driver on first use"""
+    settings = get_config()
+    if not settings.graph_enabled:
+        raise RuntimeError("Graph features are disabled, set graph_enabled")
 
-driver = GraphDatabase.driver(f'bolt://{CONFIG.neo4j_uri}',
-                              auth=basic_auth(CONFIG.neo4j_username,
-                                              CONFIG.neo4j_password))
+    neomodel_config.DATABASE_URL = (
+        f"bolt://{settings.neo4j_username}:{settings.neo4j_password}@{settings.neo4j_uri}"
+    )
+    return GraphDatabase.driver(f'bolt://{settings.neo4j_uri}',
+                                auth=basic_auth(settings.neo4j_username,
+                                                settings.neo4j_password))
 
 
 class UserNode(StructuredNode):
@@ -21,7 +38,7 @@ class UserNode(StructuredNode):
 
 def get_followers(username: str):
 
-    with driver.session() as session:
+    with get_driver().session() as session:
         result = session.execute_read(
             lambda tx: tx.run("""
             MATCH (user:UserNode {username: $username})<-[:FOLLOWS]-(follower:UserNode)
@@ -33,7 +50,7 @@ def get_followers(username: str):
 
 def get_following(username: str):
 
-    with driver.session() as session:
+    with get_driver().session() as session:
         result = session.execute_read(
             lambda tx: tx.run("""
               MATCH (user:UserNode {username: $username})-[:FOLLOWS]->(following:UserNode)
@@ -45,7 +62,7 @@ def get_following(username: str):
 
 def get_mutual_frields(username: str, other_username: str):
 
-    with driver.session() as session:
+    with get_driver().session() as session:
         result = session.execute_read(
             lambda tx: tx.run("""
             MATCH (user:UserNode {username: $username})-[:FOLLOWS]->(mutual:UserNode)<-[:FOLLOWS]-(other:UserNode {username: $other_username})
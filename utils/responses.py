@@ -0,0 +1,143 @@
+"""Conditional GET and compression for API Gateway proxy responses.
+
+Handlers wrapped with :func:`http_response` get a strong ``ETag`` on every
+successful GET, a ``304 Not Modified`` when the client already has that
+version (``If-None-Match``), and a gzip or brotli encoded body when the
+client accepts it and the body is large enough to be worth compressing.
+"""
+import base64
+import functools
+import gzip
+import hashlib
+import os
+from typing import Callable, Optional
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Bodies smaller than this are sent as is, compressing them saves little
+COMPRESSION_THRESHOLD = int(os.environ.get("COMPRESSION_THRESHOLD", 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Responses depend on the caller's token, so only the client may cache them
+# and it has to revalidate with the ETag before reusing one
+CACHE_CONTROL = "private, no-cache"
+
+
+def _headers(event: dict) -> dict[str, str]:
+    # HTTP APIs lowercase header names, REST APIs keep the client's casing
+    return {
+        name.lower(): value
+        for name, value in (event.get("headers") or {}).items()
+    }
+
+
+def _method(event: dict) -> str:
+    context = event.get("requestContext") or {}
+    return (event.get("httpMethod") or
+            (context.get("http") or {}).get("method", "GET")).upper()
+
+
+def make_etag(body: bytes, encoding: Optional[str] = None) -> str:
+    """Strong ETag for a response body.
+
+    Hashing the encoded body rather than the posts' ULIDs and ``updated_at``
+    keeps the tag correct for fields that change without ``updated_at``
+    moving, such as like counts, and for sparse fieldset requests. Strong
+    tags must differ between content codings, so the coding is appended.
+    """
+    tag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """Whether an ``If-None-Match`` header names ``etag``"""
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison, and a compressed response's tag
+    # names the same version as the uncompressed one
+    tag = etag.strip('"').split("-", 1)[0]
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        candidate = candidate.removeprefix("W/").strip('"')
+        if candidate.split("-", 1)[0] == tag:
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best content coding the client accepts"""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        _, _, quality = params.partition("q=")
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_response(event: dict, response: dict) -> dict:
+    """Add caching headers to a handler's response and compress its body"""
+    if response.get("statusCode") != 200 or _method(event) != "GET":
+        return response
+    body = response.get("body")
+    if not isinstance(body, str) or response.get("isBase64Encoded"):
+        return response
+
+    request_headers = _headers(event)
+    data = body.encode()
+    encoding = None
+    if len(data) >= COMPRESSION_THRESHOLD:
+        encoding = choose_encoding(request_headers.get("accept-encoding"))
+
+    etag = make_etag(data, encoding)
+    headers = {
+        **response.get("headers", {}),
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+
+    if etag_matches(etag, request_headers.get("if-none-match")):
+        return {"statusCode": 304, "headers": headers, "body": ""}
+    if encoding is None:
+        return {**response, "headers": headers}
+
+    headers["Content-Encoding"] = encoding
+    return {
+        **response,
+        "headers": headers,
+        "body": base64.b64encode(compress(data, encoding)).decode(),
+        "isBase64Encoded": True,
+    }
+
+
+def http_response(handler: Callable[[dict, object], dict]):
+    """Decorate a Lambda handler with ETags, 304s and compression"""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        return encode_response(event, handler(event, context))
+
+    return wrapper
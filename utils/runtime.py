@@ -0,0 +1,63 @@
+"""Long-lived event loop shared by every handler in the container.
+
+``asyncio.run`` creates and closes a loop per call, which throws away
+anything bound to it (Motor pools, cached futures, background tasks). The
+handlers dispatch through :func:`run` instead so that state survives
+between warm invocations.
+
+Set ``EVENT_LOOP=uvloop`` to run on uvloop when it is installed.
+"""
+import asyncio
+import os
+from typing import Any, Coroutine, Optional, TypeVar
+
+from utils.logging import LOG_MANAGER
+
+logger = LOG_MANAGER.getLogger(__name__)
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _new_loop() -> asyncio.AbstractEventLoop:
+    if os.environ.get("EVENT_LOOP", "asyncio").lower() == "uvloop":
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            logger.warning("uvloop requested but not installed, using asyncio")
+    return asyncio.new_event_loop()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the container's event loop, creating it on first use"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = _new_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def run(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine to completion on the shared event loop"""
+    return get_loop().run_until_complete(coro)
+
+
+def spawn(coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
+    """Schedule a background task on the running loop, or the shared one.
+
+    A reference is kept until the task finishes so it cannot be garbage
+    collected first. Lambda freezes the process between invocations, so the
+    task makes progress while later calls to :func:`run` are driving the
+    loop.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = get_loop()
+    task = loop.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task